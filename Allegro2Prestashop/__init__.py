@@ -1,20 +1,150 @@
+import Allegro2Prestashop.accounts
 import Allegro2Prestashop.core
+import Allegro2Prestashop.daemon
+import Allegro2Prestashop.journal
+import Allegro2Prestashop.logs
+import Allegro2Prestashop.metrics
+import Allegro2Prestashop.plan
 import logging
 import configparser
+import argparse
+import os
+import signal
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Sync Allegro prices with Prestashop')
+    parser.add_argument('command', nargs='?', default='sync', choices=['sync', 'plan', 'apply', 'daemon'],
+                        help='sync (default) fetches and pushes prices, plan only writes the changes into '
+                             'the plan file, apply pushes changes from the plan file, daemon keeps pushing '
+                             'price changes following Allegro offer events')
+    parser.add_argument('--full', action='store_true',
+                        help='push every matched price, ignoring the local state store')
+    parser.add_argument('--stream', action='store_true',
+                        help='update Prestashop while prices are still being fetched from Allegro')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the interrupted run, skipping the work recorded in its journal')
+    parser.add_argument('--plan-file', help='plan file, [plan] path from the config file by default')
+    parser.add_argument('--shard', type=plan.parse_shard,
+                        help='apply only i-th of N parts of the plan (i/N, e.g. 1/4), split by product id')
+    parser.add_argument('--account',
+                        help='run only for the account from [accounts] section, all of them are synced by default')
+
+    return parser.parse_args(argv)
+
+
+def export_metrics(config):
+    metrics.REGISTRY.export(config.get('metrics', 'json_path', fallback='logs/metrics.json'),
+                            config.get('metrics', 'prometheus_path', fallback='logs/allegro2prestashop.prom'))
+
+
+def run_name(args):
+    """Identifies the run in its journal, only the same run can be resumed"""
+    name = args.command + (' --full' if args.full else '') + (' --account ' + args.account if args.account else '')
+    if args.command == 'apply':
+        name += ' ' + (args.plan_file or '') + (' --shard ' + '/'.join(map(str, args.shard)) if args.shard else '')
+
+    return name
+
+
+def shard_path(file_path, shard):
+    """Shards applied on the same host don't share their journal and report files"""
+    if not shard:
+        return file_path
+
+    root, extension = os.path.splitext(file_path)
+    if extension == '.gz':
+        root, inner = os.path.splitext(root)
+        extension = inner + extension
+
+    return root + '-' + str(shard[0]) + 'of' + str(shard[1]) + extension
+
+
+def journal_path(config, args):
+    return shard_path(config.get('journal', 'path', fallback='logs/journal.jsonl'), args.shard)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
     config = configparser.ConfigParser()
     config.read('conf/config.ini')
-    log_level = int(config['log']['log_level'])
 
-    logging.basicConfig(filename='logs/app.log', filemode='w', level=log_level,
-                        format="%(asctime)s  — %(levelname)s — %(message)s")
-    fetcher = core.FetchAllegro()
-    wrapper = core.PSApiWrapper()
+    # The log of the interrupted run is kept when resuming
+    logs.setup(config, filemode='a' if args.resume else 'w')
+    plan_file = args.plan_file or config.get('plan', 'path', fallback='conf/plan.jsonl.gz')
+
+    def open_journal(run_config):
+        return journal.RunJournal(journal_path(run_config, args), run_name(args), resume=args.resume,
+                                  batch_size=int(run_config.get('journal', 'batch_size', fallback='1000')))
+
+    names = accounts.account_names(config)
+    if args.account:
+        if args.account not in names:
+            logging.error('Error: Account "' + args.account + '" not found in [accounts] section.')
+            return
+
+        config = accounts.account_config(config, args.account)
+
+    elif names:
+        if args.command != 'sync':
+            logging.error('Error: ' + args.command + ' command requires --account when several accounts are '
+                          'configured.')
+            return
+
+        accounts.Scheduler(config, names, open_journal).run(full=args.full, stream=args.stream)
+        export_metrics(config)
+        return
+
+    if args.shard:
+        config['mail']['report_path'] = shard_path(config.get('mail', 'report_path', fallback='logs/report.csv.gz'),
+                                                   args.shard)
+
+    run_journal = None
+    if args.command != 'daemon':
+        run_journal = open_journal(config)
+
+    fetcher = core.FetchAllegro(journal=run_journal, config=config, account=args.account)
+    wrapper = core.PSApiWrapper(journal=run_journal, config=config, account=args.account)
+
+    if args.command == 'plan':
+        prices, skipped = fetcher.get_prices()
+        to_update, not_updated, unchanged, conflicts, saved = wrapper.plan(prices, full=args.full)
+        plan.write_plan(plan_file, to_update, not_updated, skipped, unchanged, wrapper._net_price, conflicts, saved)
+
+    elif args.command == 'apply':
+        header, to_update = plan.read_plan(plan_file, args.shard)
+        # Products which can't be updated and conflicts are reported by the first shard only
+        first = args.shard is None or args.shard[0] == 1
+        if first:
+            wrapper.apply(to_update, header['not_updated'], header['skipped'], header['unchanged'],
+                          conflicts=header.get('conflicts', []), saved=header.get('saved', 0))
+        else:
+            wrapper.apply(to_update, [], 0)
+
+    elif args.command == 'daemon':
+        def on_reconciled():
+            export_metrics(config)
+            metrics.REGISTRY.reset()
+
+        service = daemon.Daemon(fetcher, wrapper, config, on_reconciled=on_reconciled)
+        signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+        service.run()
+
+    elif args.stream:
+        wrapper.update_stream(fetcher, full=args.full)
+
+    else:
+        prices, skipped = fetcher.get_prices()
+        wrapper.update_all(prices, skipped, full=args.full)
+
+    fetcher.close()
+    wrapper.close()
+
+    if run_journal is not None:
+        run_journal.finish()
 
-    prices, skipped = fetcher.get_prices()
-    wrapper.update_all(prices, skipped)
+    export_metrics(config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import configparser
+import threading
+import logging
+from Allegro2Prestashop import core, mail, matching, metrics, records, transport
+
+
+def account_names(config):
+    """Returns names of the accounts listed in [accounts], empty if there's a single account"""
+    return [name.strip() for name in config.get('accounts', 'names', fallback='').split(',') if name.strip()]
+
+
+def account_config(config, name):
+    """Returns config of the account - options of [section:name] sections override the ones of [section]
+
+    Token file, state store, run journal and report file of the account are kept apart from the other accounts,
+    unless their paths are set in its sections.
+    """
+    account = configparser.ConfigParser()
+    account.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections()})
+
+    defaults = {'allegro': {'token_path': 'conf/token-' + name + '.json'},
+                'state': {'path': 'conf/state-' + name + '.db'},
+                'journal': {'path': 'logs/journal-' + name + '.jsonl'},
+                'mail': {'report_path': 'logs/report-' + name + '.csv.gz'}}
+
+    for section, options in defaults.items():
+        if not account.has_section(section):
+            account.add_section(section)
+        account[section].update(options)
+
+    for section in config.sections():
+        base, _, suffix = section.partition(':')
+        if suffix == name:
+            if not account.has_section(base):
+                account.add_section(base)
+            account.read_dict({base: dict(config.items(section, raw=True))})
+
+    return account
+
+
+class CatalogCache(object):
+    """Prestashop catalogs loaded once for all accounts feeding the same store
+
+    Every caller gets its own EanIndex, as matching marks the products in it.
+    """
+
+    def __init__(self):
+        self.catalogs = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, fields, load):
+        """Returns EanIndex of the store catalog, load(fields) is called by the first caller only"""
+        key = (url, fields)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+
+        with lock:
+            if key not in self.catalogs:
+                index = load(fields)
+                if index is None:
+                    return None
+
+                self.catalogs[key] = [(product.ean, product.product_id, product.price)
+                                      for product in index.products]
+            else:
+                logging.debug('Reusing catalog of %s', url)
+
+        return matching.EanIndex(records.PSProduct(*product) for product in self.catalogs[key])
+
+
+class Scheduler(object):
+    """Syncs several Allegro accounts, each feeding its Prestashop store, concurrently in one process
+
+    Every account has its own token, state store, journal, concurrency and rate limits. Connection pools are
+    shared by all of them, so is the catalog of a store fed by several accounts. The results are sent in one
+    combined report, with the [mail] settings of the first account.
+    """
+
+    def __init__(self, config, names, open_journal=None):
+        self.config = config
+        self.accounts = {name: account_config(config, name) for name in names}
+        self.open_journal = open_journal
+        self.catalog_cache = CatalogCache()
+
+        http2 = config.getboolean('transport', 'http2', fallback=False)
+        allegro_pool = sum(int(account.get('engine', 'allegro_concurrency', fallback='10'))
+                           for account in self.accounts.values())
+        prestashop_pool = sum(int(account.get('engine', 'prestashop_concurrency', fallback='10'))
+                              for account in self.accounts.values())
+        stores = {account.get('api', 'url', fallback='') for account in self.accounts.values()}
+
+        # API and auth hosts of Allegro
+        self.allegro_session = transport.create_session(allegro_pool, http2, hosts=2)
+        self.prestashop_session = transport.create_session(prestashop_pool, http2, hosts=len(stores))
+
+    def _sync(self, name, full, stream, results):
+        config = self.accounts[name]
+        run_journal = None
+        wrapper = None
+        report = None
+
+        try:
+            if self.open_journal is not None:
+                run_journal = self.open_journal(config)
+
+            fetcher = core.FetchAllegro(journal=run_journal, config=config, session=self.allegro_session,
+                                        account=name)
+            wrapper = core.PSApiWrapper(journal=run_journal, config=config, session=self.prestashop_session,
+                                        account=name, catalog_cache=self.catalog_cache)
+
+            logging.info('Syncing account ' + name + ' with ' + wrapper.api_url)
+            try:
+                if stream:
+                    report = wrapper.update_stream(fetcher, full=full, send_report=False)
+                else:
+                    prices, skipped = fetcher.get_prices()
+                    report = wrapper.update_all(prices, skipped, full=full, send_report=False)
+
+            finally:
+                fetcher.close()
+                wrapper.close()
+
+        except Exception as error:
+            logging.exception(f'Error occurred while syncing account {name}: {error}')
+
+        else:
+            logging.info('Account ' + name + ' synced')
+
+        # A failed run is left in its journal, so it can be resumed
+        if run_journal is not None:
+            if report is None:
+                run_journal.close()
+            else:
+                run_journal.finish()
+
+        results[name] = (wrapper, report)
+
+    def run(self, full=False, stream=False):
+        """Syncs all accounts and sends the combined report, returns {name: report or None if the sync failed}"""
+        results = {}
+        threads = [threading.Thread(target=self._sync, args=(name, full, stream, results), name=name)
+                   for name in self.accounts]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.allegro_session.close()
+        self.prestashop_session.close()
+
+        self._send_report(results)
+
+        return {name: report for name, (_, report) in results.items()}
+
+    @metrics.REGISTRY.timed('report')
+    def _send_report(self, results):
+        """Queues one mail with the summaries of all accounts and their report files attached"""
+        totals = {}
+        sections = []
+        attachments = []
+        mailer = None
+
+        for name, account in self.accounts.items():
+            wrapper, report = results[name]
+            header = name + ' - ' + account.get('api', 'url', fallback='')
+            if mailer is None:
+                mailer = wrapper
+
+            if report is None:
+                sections.append(header + '\n\nSync failed, see the log for details.')
+                continue
+
+            for key, value in report.values.items():
+                totals[key] = totals.get(key, 0) + value
+
+            sections.append(header + '\n\n' + report.summary())
+            attachments.append(mail.attachment(report.file_path))
+
+        for name, value in totals.items():
+            metrics.REGISTRY.set(name, value)
+
+        if mailer is None:
+            logging.error('Report not sent - no account could be set up')
+            return
+
+        mail.MAILER.send(mailer.mail_settings, '\n\n\n'.join(sections) + '\n\n' + metrics.REGISTRY.summary(),
+                         attachments, description='report')
@@ -1,46 +1,102 @@
-import requests
 from requests.exceptions import HTTPError, ConnectionError
 import configparser
 import base64
-import smtplib
 import time
 import json
+import hashlib
 from os import path
 import logging
 from xml.etree import ElementTree
 from xml.etree.ElementTree import ParseError
 import concurrent.futures
+import asyncio
+import functools
+import queue
+import threading
+from Allegro2Prestashop import logs, mail, matching, metrics, records, report, sinks, state, transport
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# Price update modes and whether they use PATCH, auto detects it with the first update of the run
+UPDATE_MODES = {'auto': None, 'patch': True, 'put': False}
+# Responses of shops which don't support PATCH method (Prestashop before 1.7.8)
+PATCH_UNSUPPORTED = (400, 405, 501)
+
+# Listing fields which change without the offer details (EAN, external id) being modified
+VOLATILE_OFFER_FIELDS = ('sellingMode', 'stock', 'stats', 'publication', 'saleInfo')
+
+
+def get_engine(config):
+    engine = config.get('engine', 'mode', fallback='threaded')
+
+    if engine == 'async' and aiohttp is None:
+        logging.error('Error: async engine requires aiohttp package. Using threaded instead.')
+        return 'threaded'
+
+    if engine not in ('threaded', 'async'):
+        logging.error('Error: Engine "' + engine + '" is not supported. Using threaded instead.')
+        return 'threaded'
+
+    return engine
+
+
+def read_config():
+    config = configparser.ConfigParser()
+    config.read('conf/config.ini')
+
+    return config
 
 
 class FetchAllegro(object):
-    """Fetches data from Allegro API"""
+    """Fetches data from Allegro API
 
-    def __init__(self):
-        config = configparser.ConfigParser()
-        config.read('conf/config.ini')
+    config is read from conf/config.ini unless it's given, e.g. the one of an account (see accounts.py).
+    """
+
+    def __init__(self, journal=None, config=None, session=None, account=None):
+        if config is None:
+            config = read_config()
+
+        self.config = config
+        self.journal = journal
+        self.account = account
 
         self.client_id = config['allegro']['client_id']
         self.client_secret = config['allegro']['client_secret']
 
-        self.receiver = config['mail_auth']['receiver']
-        self.subject = config['mail_auth']['subject']
+        self.mail_settings = mail.MailSettings(config, 'mail_auth')
         self.content = config['mail_auth']['content'].replace("\\n", "\n")
-        self.user = config['mail_auth']['user']
-        self.passwd = config['mail_auth']['passwd']
-        self.server = config['mail_auth']['server']
-        self.port = int(config['mail_auth']['port'])
 
-        self.log_level = int(config['log']['log_level'])
+        self.progress_interval = float(config.get('log', 'progress_interval', fallback='10'))
+
+        self.state_path = config.get('state', 'path', fallback='conf/state.db')
+        self.offer_ttl = float(config.get('state', 'offer_ttl', fallback='7')) * 86400
+
+        self.engine = get_engine(config)
+        self.concurrency = int(config.get('engine', 'allegro_concurrency', fallback='10'))
 
-        self.api_url = 'https://api.allegro.pl/'
-        self.auth_url = 'https://allegro.pl/auth/oauth/'
+        self.api_url = config.get('allegro', 'api_url', fallback='https://api.allegro.pl/')
+        self.auth_url = config.get('allegro', 'auth_url', fallback='https://allegro.pl/auth/oauth/')
+        self.refresh_margin = float(config.get('allegro', 'token_refresh_margin', fallback='300'))
+        self.token_path = config.get('allegro', 'token_path', fallback='conf/token.json')
 
-        self.token = self._authorize()
+        self.transport = transport.Transport.from_config(config, 'allegro', pool_size=self.concurrency,
+                                                         session=session)
+
+        # Authorization is deferred until the first request, so construction does no network I/O
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
 
         self.products = []
+        self._emit = self.products.append
         self.skipped = 0
         self.products_count = 1
-        self.offers_quantity = self._get_offers_quantity()
+        self.offers_quantity = None
 
         logging.debug('Successfully initialized config.')
         logging.debug('Class Fetch Allegro initialized!')
@@ -53,29 +109,14 @@ class FetchAllegro(object):
         return b64_secrets
 
     def _send_mail(self, content):
-        mail_tpl = f'From: {self.user}' + f'\nTo: {self.receiver}' + f'\nSubject: {self.subject}' + f'\n\n{content}'
-
-        try:
-            server = smtplib.SMTP_SSL(self.server, self.port)
-
-            if self.log_level <= 10:
-                server.set_debuglevel(True)
+        mail.MAILER.send(self.mail_settings, content, description='token refresh email')
 
-            server.ehlo()
-            server.login(self.user, self.passwd)
-            server.sendmail(self.user, self.receiver.split(', '), mail_tpl.encode('utf-8'))
-            server.close()
-
-        except Exception as e:
-            logging.error('Something went wrong with mail...' + str(e))
-
-        else:
-            logging.info('Successfully sent token refresh email!')
+    def _store_tokens(self, data):
+        if 'expires_at' not in data:
+            data['expires_at'] = time.time() + float(data.get('expires_in', 0))
 
-    @staticmethod
-    def _store_tokens(data):
         try:
-            with open('conf/token.json', 'w+') as outfile:
+            with open(self.token_path, 'w+') as outfile:
                 outfile.truncate(0)
                 json.dump(data, outfile)
 
@@ -85,10 +126,9 @@ class FetchAllegro(object):
         else:
             logging.debug('Successfully stored tokens!')
 
-    @staticmethod
-    def _get_tokens():
+    def _get_tokens(self):
         try:
-            with open('conf/token.json', 'r') as infile:
+            with open(self.token_path, 'r') as infile:
                 token = json.load(infile)
 
         except Exception as e:
@@ -100,9 +140,9 @@ class FetchAllegro(object):
 
     def _new_token(self, b64_secrets):
         try:
-            auth_request = requests.post(self.auth_url + 'device?client_id=' + self.client_id,
-                                         headers={'Authorization': 'Basic ' + b64_secrets,
-                                                  'Content-Type': 'application/x-www-form-urlencoded'})
+            auth_request = self.transport.post(self.auth_url + 'device?client_id=' + self.client_id,
+                                               headers={'Authorization': 'Basic ' + b64_secrets,
+                                                        'Content-Type': 'application/x-www-form-urlencoded'})
 
             self.auth_response = auth_request.json()
 
@@ -110,7 +150,7 @@ class FetchAllegro(object):
             self._send_mail(self.content + self.auth_response['verification_uri_complete'])
 
             while True:
-                check_request = requests.post(
+                check_request = self.transport.post(
                     self.auth_url +
                     'token?grant_type=urn%3Aietf%3Aparams%3Aoauth%3Agrant-type%3Adevice_code&device_code=' +
                     self.auth_response["device_code"], headers={'Authorization': 'Basic ' + b64_secrets})
@@ -118,7 +158,7 @@ class FetchAllegro(object):
 
                 if 'access_token' in check_response:
                     self._store_tokens(check_response)
-                    token = check_response['access_token']
+                    tokens = check_response
                     logging.debug('Token access granted!')
                     break
 
@@ -138,32 +178,45 @@ class FetchAllegro(object):
 
         else:
             logging.debug('The new token is now authorized!')
-            return token
+            return tokens
 
-    def _authorize(self):
+    @metrics.REGISTRY.timed('authorize')
+    def _authorize(self, reuse=True):
+        """Reuses the stored access token while it's valid, otherwise refreshes it or asks for a new one"""
         try:
             b64_secrets = self._encode()
-            if path.isfile('conf/token.json') and path.getsize('conf/token.json') != 0:
+            if path.isfile(self.token_path) and path.getsize(self.token_path) != 0:
                 old_tokens = self._get_tokens()
 
-                refresh_response = requests.get(self.auth_url + 'token?grant_type=refresh_token&refresh_token=' +
-                                                old_tokens["refresh_token"], headers={'Authorization': 'Basic ' +
-                                                                                                       b64_secrets
-                                                                                      }).json()
+            else:
+                old_tokens = None
+
+            if reuse and old_tokens and 'access_token' in old_tokens and \
+                    old_tokens.get('expires_at', 0) - self.refresh_margin > time.time():
+                tokens = old_tokens
+                logging.debug('Reusing stored access token!')
+
+            elif old_tokens:
+                refresh_response = self.transport.get(self.auth_url + 'token?grant_type=refresh_token&refresh_token=' +
+                                                      old_tokens["refresh_token"],
+                                                      headers={'Authorization': 'Basic ' + b64_secrets}).json()
 
                 if 'access_token' in refresh_response:
                     self._store_tokens(refresh_response)
-                    token = refresh_response["access_token"]
+                    tokens = refresh_response
                     logging.debug('Authorized by refresh token!')
 
                 elif 'error' in refresh_response:
-                    token = self._new_token(b64_secrets)
+                    tokens = self._new_token(b64_secrets)
 
                 else:
                     raise RuntimeError('Undefined error when refreshing the token. '
                                        'Please contact with the administrator.')
             else:
-                token = self._new_token(b64_secrets)
+                tokens = self._new_token(b64_secrets)
+
+            self._token = tokens['access_token']
+            self._token_expires = float(tokens['expires_at'])
 
         except HTTPError as http_error:
             logging.error(f'HTTP error occurred while authorizing: {http_error}')
@@ -173,122 +226,431 @@ class FetchAllegro(object):
 
         else:
             logging.info('Successfully authorized - Allegro')
-            return token
+            return self._token
 
-    def _get_offers_quantity(self):
-        try:
-            offers_quantity_request = requests.get(self.api_url + 'sale/offers?limit=1&offset=0',
-                                                   headers={'Authorization': 'Bearer ' + self.token,
-                                                            'Accept': 'application/vnd.allegro.public.v1+json'})
-            offers_quantity = int(offers_quantity_request.json()["totalCount"])
+    @property
+    def token(self):
+        """Valid access token, refreshed once for all workers shortly before it expires"""
+        if time.time() >= self._token_expires - self.refresh_margin:
+            with self._token_lock:
+                if time.time() >= self._token_expires - self.refresh_margin:
+                    self._authorize(reuse=self._token is None)
 
-        except HTTPError as http_error:
-            logging.error(f'HTTP error occurred while getting offers quantity: {http_error}')
-        except Exception as error:
-            logging.error(f'Other error occurred while getting offers quantity: {error}')
-        else:
-            return offers_quantity
+                if self._token is None or time.time() >= self._token_expires:
+                    raise RuntimeError('Allegro authorization failed!')
+
+        return self._token
+
+    def _invalidate_token(self, headers):
+        """Forces refresh after 401, unless another worker has already replaced the rejected token"""
+        with self._token_lock:
+            if headers['Authorization'] == 'Bearer ' + str(self._token):
+                self._token_expires = 0.0
+
+    def _auth_headers(self):
+        return {'Authorization': 'Bearer ' + self.token, 'Accept': 'application/vnd.allegro.public.v1+json'}
+
+    @staticmethod
+    def _offer_marker(offer):
+        if offer.get("updatedAt"):
+            return offer["updatedAt"]
+
+        entry = {key: value for key, value in offer.items() if key not in VOLATILE_OFFER_FIELDS}
+        return hashlib.sha1(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _offer_status(offer):
+        """Publication status from the listing entry, None for offers replayed from the journal"""
+        return (offer.get("publication") or {}).get("status")
+
+    @staticmethod
+    def _parse_offer(offer_response):
+        external_id = None
+        if offer_response.get("external") is not None:
+            external_id = offer_response["external"]["id"]
+
+        ean = None
+        for parameter in offer_response["parameters"]:
+            if parameter["id"] == '225693':
+                ean = str(parameter["values"][0])
+                break
 
-    def _get_price(self, s, offer, first=True):
+        return ean, external_id
+
+    def _add_price(self, offer, detail, price):
+        """Collects result of a single offer - called only from the thread driving the fetch"""
         try:
-            offer_request = s.get(self.api_url + 'sale/offers/' + offer["id"])
-            offer_response = offer_request.json()
+            if detail is None:
+                return
 
-            if offer_response["external"] is not None:
-                if offer_response["external"]["id"] == '*':
-                    self.skipped += 1
-                    raise RuntimeError(str(self.products_count) + '/' + str(self.offers_quantity) +
-                                       ': Product on blacklist - * detected!')
+            ean, external_id = detail
 
-            product = []
-            for parameter in offer_response["parameters"]:
-                if parameter["id"] == '225693':
-                    product.append(str(parameter["values"][0]))
+            if external_id == '*':
+                self.skipped += 1
+                raise RuntimeError('Product on blacklist - * detected!')
 
-            if not product:
-                product = [None, offer_response["sellingMode"]["price"]["amount"], offer["id"]]
-                self.products.append(product)
+            status = self._offer_status(offer)
+            self._emit(records.Offer(ean, price, offer["id"], None if status is None else status == 'ACTIVE'))
 
-                raise RuntimeError(str(self.products_count) + '/' + str(self.offers_quantity) + ': EAN not found!')
+            if ean is None:
+                raise RuntimeError('EAN not found!')
+
+        except RuntimeError as run_error:
+            logging.error('An error occurred while getting the price of offer %s (%d/%s): %s', offer["id"],
+                          self.products_count, self.offers_quantity, run_error)
 
-            product.extend((offer_response["sellingMode"]["price"]["amount"], offer["id"]))
-            self.products.append(product)
+        finally:
+            self.products_count += 1
+            self.progress.advance()
 
-            logging.info(str(self.products_count) + '/' + str(self.offers_quantity))
+    def _get_price(self, s, offer):
+        """Returns (detail, price) of the offer or (None, None) if it couldn't be fetched"""
+        try:
+            headers = self._auth_headers()
+            offer_request = s.get(self.api_url + 'sale/offers/' + offer["id"], headers=headers)
+            if offer_request.status_code == 401:
+                self._invalidate_token(headers)
+                offer_request = s.get(self.api_url + 'sale/offers/' + offer["id"], headers=self._auth_headers())
+
+            offer_request.raise_for_status()
+            offer_response = offer_request.json()
+
+            detail = self._parse_offer(offer_response)
+            price = offer_response["sellingMode"]["price"]["amount"]
 
         except ConnectionError as con_error:
             logging.error(f'Connection error occurred while getting the price: {con_error}')
-            if "('Connection aborted.', RemoteDisconnected('Remote end closed connection without response'))" == \
-                    str(con_error):
-                if first:
-                    logging.warning('Trying again due to the dropped connection...')
-                    self._get_price(s, offer, first=False)
 
         except HTTPError as http_error:
             logging.error(f'HTTP error occurred while getting the price: {http_error}')
 
-        except RuntimeError as run_error:
-            logging.error(f'An error occurred while getting the price: {run_error}')
+        except Exception as error:
+            logging.error(f'Other error occurred while getting the price: {error}')
+
+        else:
+            return detail, price
+
+        return None, None
+
+    async def _get_price_async(self, session, offer):
+        try:
+            headers = self._auth_headers()
+            offer_request = await session.get(self.api_url + 'sale/offers/' + offer["id"], headers=headers)
+            if offer_request.status == 401:
+                self._invalidate_token(headers)
+                offer_request = await session.get(self.api_url + 'sale/offers/' + offer["id"],
+                                                  headers=self._auth_headers())
+
+            offer_request.raise_for_status()
+            offer_response = await offer_request.json(content_type=None)
+
+            detail = self._parse_offer(offer_response)
+            price = offer_response["sellingMode"]["price"]["amount"]
+
+        except aiohttp.ClientConnectionError as con_error:
+            logging.error(f'Connection error occurred while getting the price: {con_error}')
+
+        except aiohttp.ClientResponseError as http_error:
+            logging.error(f'HTTP error occurred while getting the price: {http_error}')
 
         except Exception as error:
             logging.error(f'Other error occurred while getting the price: {error}')
 
         else:
-            if not first:
-                logging.info('Successfully got price after retry!')
+            return detail, price
 
-        finally:
-            self.products_count += 1
+        return None, None
 
-    def get_prices(self):
-        with requests.Session() as s:
-            s.headers.update({'Authorization': 'Bearer ' + self.token,
-                              'Accept': 'application/vnd.allegro.public.v1+json'})
+    def _record_price(self, offer, detail, price):
+        if self.journal is not None:
+            self.journal.offer(offer["id"], detail, price, self._offer_status(offer))
 
-            for i in range(0, self.offers_quantity, 1000):
-                try:
-                    offers_request = s.get(self.api_url + 'sale/offers?limit=1000&offset=' + str(i))
+        self._add_price(offer, detail, price)
+
+    def _is_cached(self, offer, cached, marker):
+        if self.journal is not None and offer["id"] in self.journal.offers:
+            return True
+
+        if cached is not None and cached[0] == marker:
+            self._record_price(offer, cached[1:], offer["sellingMode"]["price"]["amount"])
+            return True
+
+        return False
+
+    def _collect(self, store, offer, marker, detail, price):
+        if detail is not None:
+            store.record_offer(offer["id"], marker, *detail)
 
-                    offers = offers_request.json()
+        self._record_price(offer, detail, price)
+
+    def _is_page_done(self, offset):
+        """True if the listing page was completed by the interrupted run which is being resumed"""
+        if self.journal is None or offset not in self.journal.pages:
+            return False
+
+        self.offers_quantity = self.journal.pages[offset]
+        self.progress.total = self.offers_quantity
+        logging.info('Skipping offers ' + str(offset) + '-' + str(offset + 1000) + ' done by the interrupted run')
+        return True
+
+    def _finish_page(self, store, offset):
+        """Stores details of the listing page, its offers are skipped when the run is resumed"""
+        store.commit()
+        if self.journal is not None:
+            self.journal.page(offset, self.offers_quantity)
+
+    def _get_prices_threaded(self, store, cache):
+        s = self.transport
+
+        i = 0
+        while self.offers_quantity is None or i < self.offers_quantity:
+            if self._is_page_done(i):
+                i += 1000
+                continue
+
+            try:
+                with metrics.REGISTRY.phase('listing_pages'):
+                    offers_request = s.get(self.api_url + 'sale/offers?limit=1000&offset=' + str(i),
+                                           headers=self._auth_headers())
+
+                offers = offers_request.json()
+                offers_request.raise_for_status()
+
+            except HTTPError as http_error:
+                logging.exception(f'HTTP error occurred while getting prices: {http_error}')
+
+            except Exception as error:
+                logging.exception(f'Other error occurred while getting prices: {error}')
+
+            else:
+                self.offers_quantity = int(offers["totalCount"])
+                self.progress.total = self.offers_quantity
+
+                with metrics.REGISTRY.phase('offer_details'), \
+                        concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    futures = {}
+                    for offer in offers["offers"]:
+                        marker = self._offer_marker(offer)
+                        if not self._is_cached(offer, cache.get(offer["id"]), marker):
+                            futures[executor.submit(self._get_price, s=s, offer=offer)] = (offer, marker)
+
+                    for future in concurrent.futures.as_completed(futures):
+                        self._collect(store, *futures[future], *future.result())
+
+                self._finish_page(store, i)
+
+                logging.info('Fetched details of ' + str(len(futures)) + ' new or modified offers')
+
+            if self.offers_quantity is None:
+                logging.error('Offers quantity unknown - the first page of offers could not be fetched!')
+                break
+
+            logging.info('Successfully fetched offers ' + str(i) + '-' + str(i + 1000) + '!')
+            i += 1000
+
+    async def _get_prices_async(self, store, cache):
+        async with transport.AsyncTransport.from_config(self.config, 'allegro', pool_size=self.concurrency) as session:
+            async def fetch(offer, marker):
+                return (offer, marker) + await self._get_price_async(session, offer)
+
+            # Details are collected as soon as they arrive, a page is done once all of its offers are collected
+            def collected(offset, task):
+                self._collect(store, *task.result())
+                remaining[offset] -= 1
+                if not remaining[offset]:
+                    self._finish_page(store, offset)
+
+            pending = []
+            remaining = {}
+
+            i = 0
+            while self.offers_quantity is None or i < self.offers_quantity:
+                if self._is_page_done(i):
+                    i += 1000
+                    continue
+
+                try:
+                    with metrics.REGISTRY.phase('listing_pages'):
+                        offers_request = await session.get(self.api_url + 'sale/offers?limit=1000&offset=' + str(i),
+                                                           headers=self._auth_headers())
+                    offers = await offers_request.json(content_type=None)
                     offers_request.raise_for_status()
 
-                except HTTPError as http_error:
+                except aiohttp.ClientResponseError as http_error:
                     logging.exception(f'HTTP error occurred while getting prices: {http_error}')
 
                 except Exception as error:
                     logging.exception(f'Other error occurred while getting prices: {error}')
 
                 else:
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                        futures = []
-                        for offer in offers["offers"]:
-                            futures.append(executor.submit(self._get_price, s=s, offer=offer))
+                    self.offers_quantity = int(offers["totalCount"])
+                    self.progress.total = self.offers_quantity
+                    remaining[i] = 0
+
+                    for offer in offers["offers"]:
+                        marker = self._offer_marker(offer)
+                        if not self._is_cached(offer, cache.get(offer["id"]), marker):
+                            task = asyncio.ensure_future(fetch(offer, marker))
+                            task.add_done_callback(functools.partial(collected, i))
+                            pending.append(task)
+                            remaining[i] += 1
+
+                    if not remaining[i]:
+                        self._finish_page(store, i)
+
+                if self.offers_quantity is None:
+                    logging.error('Offers quantity unknown - the first page of offers could not be fetched!')
+                    break
 
-                logging.info('Successfully fetched offers ' + str(i) + '-' + str(i + 1000) + '!')
+                logging.info('Successfully listed offers ' + str(i) + '-' + str(i + 1000) + '!')
+                i += 1000
+
+            with metrics.REGISTRY.phase('offer_details'):
+                await asyncio.gather(*pending)
+
+            logging.info('Fetched details of ' + str(len(pending)) + ' new or modified offers')
+
+    def get_prices(self, emit=None):
+        # The fetcher may be reused, e.g. by reconciliations of the daemon
+        self.products = []
+        self._emit = emit or self.products.append
+        self.skipped = 0
+        self.products_count = 1
+        self.offers_quantity = None
+        self.progress = logs.Progress('Offers', interval=self.progress_interval, account=self.account)
+
+        if self.journal is not None and self.journal.offers:
+            logging.info('Replaying ' + str(len(self.journal.offers)) + ' offers fetched by the interrupted run')
+            for offer_id, (detail, price, status) in self.journal.offers.items():
+                self._add_price({'id': offer_id, 'publication': {'status': status}}, detail, price)
+
+        with state.StateStore(self.state_path) as store:
+            cache = store.get_offers(self.offer_ttl)
+            logging.info('Loaded ' + str(len(cache)) + ' cached offer details')
+
+            if self.engine == 'async':
+                asyncio.run(self._get_prices_async(store, cache))
+            else:
+                self._get_prices_threaded(store, cache)
+
+        self.progress.finish()
 
         return self.products, self.skipped
 
+    def get_offer_events(self, cursor=None, types=(), limit=1000):
+        """Returns offer events following the cursor event id, the oldest ones kept by Allegro if it's None"""
+        url = self.api_url + 'sale/offer-events?limit=' + str(limit) + ''.join('&type=' + kind for kind in types)
+        if cursor is not None:
+            url += '&from=' + cursor
+
+        events_request = self.transport.get(url, headers=self._auth_headers())
+        events_request.raise_for_status()
+
+        return events_request.json()["offerEvents"]
+
+    def get_offer_prices(self, offer_ids):
+        """Fetches details of given offers, returns Offer list without the blacklisted and unavailable ones"""
+        offers = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self._get_price, s=self.transport, offer={'id': offer_id}): offer_id
+                       for offer_id in offer_ids}
+
+            for future in concurrent.futures.as_completed(futures):
+                detail, price = future.result()
+                if detail is None:
+                    continue
+
+                ean, external_id = detail
+                if external_id == '*':
+                    logging.debug('Offer %s on blacklist - * detected!', futures[future])
+                    continue
+
+                offers.append(records.Offer(ean, price, futures[future]))
+
+        return offers
+
+    def iter_prices(self, queue_size=1000):
+        """Starts fetching in the background and returns generator of prices available so far"""
+        prices = queue.Queue(queue_size)
+        done = object()
+
+        def produce():
+            try:
+                self.get_prices(emit=prices.put)
+            finally:
+                prices.put(done)
+
+        producer = threading.Thread(target=produce, name='FetchAllegro', daemon=True)
+        producer.start()
+
+        def consume():
+            while True:
+                product = prices.get()
+                if product is done:
+                    break
+                yield product
+
+            producer.join()
+
+        return consume()
+
+    def close(self):
+        self.transport.close()
+
 
 class PSApiWrapper(object):
-    """Prestashop API wrapper class"""
+    """Prestashop API wrapper class
+
+    config is read from conf/config.ini unless it's given. Wrappers of the stores fed by several accounts
+    share the catalog through catalog_cache.
+    """
 
-    def __init__(self):
-        config = configparser.ConfigParser()
-        config.read('conf/config.ini')
+    def __init__(self, journal=None, config=None, session=None, account=None, catalog_cache=None):
+        if config is None:
+            config = read_config()
+
+        self.config = config
+        self.journal = journal
+        self.account = account
+        self.catalog_cache = catalog_cache
 
         self.api_url = config['api']['url']
         self.api_key = config['api']['key']
         self.token = self._encode()
 
-        self.receiver = config['mail']['receiver']
-        self.subject = config['mail']['subject']
+        self.mail_settings = mail.MailSettings(config, 'mail')
         self.content_lang = config['mail']['content_lang']
-        self.user = config['mail']['user']
-        self.passwd = config['mail']['passwd']
-        self.server = config['mail']['server']
-        self.port = int(config['mail']['port'])
+        self.report_path = config.get('mail', 'report_path', fallback='logs/report.csv.gz')
+
+        self.progress_interval = float(config.get('log', 'progress_interval', fallback='10'))
+
+        self.state_path = config.get('state', 'path', fallback='conf/state.db')
+
+        self.engine = get_engine(config)
+        self.concurrency = int(config.get('engine', 'prestashop_concurrency', fallback='10'))
+        self.queue_size = int(config.get('engine', 'queue_size', fallback='1000'))
+
+        self.catalog_page_size = int(config.get('catalog', 'page_size', fallback='1000'))
+        self.catalog_concurrency = int(config.get('catalog', 'concurrency', fallback='4'))
+        self.catalog_prices = config.getboolean('catalog', 'fetch_prices', fallback=True)
+
+        self.coalescer = matching.Coalescer.from_config(config)
 
-        self.log_level = config['log']['log_level']
+        self.transport = transport.Transport.from_config(config, 'prestashop', pool_size=self.concurrency,
+                                                         session=session)
+        self.transport.headers.update({'Authorization': 'Basic ' + self.token})
+
+        update_mode = config.get('engine', 'update_mode', fallback='auto')
+        if update_mode not in UPDATE_MODES:
+            logging.error('Error: Update mode "' + update_mode + '" is not supported. Using auto instead.')
+            update_mode = 'auto'
+
+        # None until the first PATCH of the run tells whether the shop supports it
+        self.patch_supported = UPDATE_MODES[update_mode]
+        self.patch_lock = threading.Lock()
+
+        self.sink = sinks.get_sink(self, config)
 
         logging.debug('Config initialized.')
         logging.debug('Class PSAApiWrapper initialized!')
@@ -304,20 +666,101 @@ class PSApiWrapper(object):
             logging.debug('Token encoded.')
             return token
 
-    def _update(self, product_id, price, s, first=True):
+    @staticmethod
+    def _net_price(price):
+        return str(round((float(price) / 1.23), 2))
+
+    @staticmethod
+    def _build_update_xml(get_response, net_price):
+        tree = ElementTree.fromstring(get_response)
+        tree.find("./product/price").text = net_price
+        product = tree.find("./product")
+        product.remove(tree.find("./product/manufacturer_name"))
+        product.remove(tree.find("./product/quantity"))
+
+        return ElementTree.tostring(tree, encoding='utf8', method='xml')
+
+    @staticmethod
+    def _build_patch_xml(product_id, net_price):
+        tree = ElementTree.Element('prestashop')
+        product = ElementTree.SubElement(tree, 'product')
+        ElementTree.SubElement(product, 'id').text = product_id
+        ElementTree.SubElement(product, 'price').text = net_price
+
+        return ElementTree.tostring(tree, encoding='utf8', method='xml')
+
+    @staticmethod
+    def _check_update(update_response, product_id, net_price):
+        # Prestashop returns the id as a number and the price with 6 decimal places
+        if str(update_response["product"]["id"]) == product_id:
+            if float(update_response["product"]["price"]) == float(net_price):
+                logging.debug('Successfully updated product %s', product_id)
+                return True
+
+        else:
+            logging.error('Undefined error occurred while updating product ' + product_id)
+
+        return False
+
+    def _patch_unsupported(self, status):
+        """Switches to GET + PUT updates for the rest of the run if the shop rejects PATCH method"""
+        if self.patch_supported is None and status in PATCH_UNSUPPORTED:
+            logging.warning('PATCH method not supported by the shop (HTTP ' + str(status) + '). '
+                            'Using GET + PUT updates instead.')
+            self.patch_supported = False
+
+        elif self.patch_supported is None:
+            logging.debug('PATCH method supported by the shop')
+            self.patch_supported = True
+
+        return self.patch_supported is False
+
+    def _update(self, product_id, price, s):
+        """Updates the price with PATCH, the first PATCH of the run tells whether the shop supports it"""
+        if self.patch_supported is None:
+            with self.patch_lock:
+                if self.patch_supported is None:
+                    success = self._update_patch(product_id, price, s)
+                    if self.patch_supported is not False:
+                        return success
+
+        if self.patch_supported:
+            return self._update_patch(product_id, price, s)
+
+        return self._update_full(product_id, price, s)
+
+    def _update_patch(self, product_id, price, s):
+        try:
+            net_price = self._net_price(price)
+            update_request = s.patch(self.api_url + 'products/' + product_id, headers={'Io-Format': 'JSON'},
+                                     data=self._build_patch_xml(product_id, net_price))
+
+            if self._patch_unsupported(update_request.status_code):
+                return False
+
+            update_response = update_request.json()
+            update_request.raise_for_status()
+            logging.debug('Sent patch price request')
+
+        except HTTPError as http_error:
+            logging.exception('HTTP error occurred while updating product ' + product_id + f': {http_error}')
+
+        except Exception as error:
+            logging.exception(f'Other error occurred while updating product ' + product_id + f': {error}')
+
+        else:
+            return self._check_update(update_response, product_id, net_price)
+
+        return False
+
+    def _update_full(self, product_id, price, s):
         try:
             get_request = s.get(self.api_url + 'products/' + product_id)
 
             get_response = get_request.content
 
-            tree = ElementTree.fromstring(get_response)
-            net_price = str(round((float(price) / 1.23), 2))
-            tree.find("./product/price").text = net_price
-            product = tree.find("./product")
-            product.remove(tree.find("./product/manufacturer_name"))
-            product.remove(tree.find("./product/quantity"))
-
-            update_xml = ElementTree.tostring(tree, encoding='utf8', method='xml')
+            net_price = self._net_price(price)
+            update_xml = self._build_update_xml(get_response, net_price)
 
             get_request.raise_for_status()
             logging.debug('Sent get xml form request')
@@ -330,10 +773,6 @@ class PSApiWrapper(object):
 
         except HTTPError as http_error:
             logging.exception('HTTP error occurred while updating product ' + product_id + f': {http_error}')
-            if '500 Server Error' in str(http_error):
-                if first:
-                    logging.warning('Trying again due to Server Error...')
-                    self._update(product_id, price, s, first=False)
 
         except ParseError as parse_error:
             logging.exception(f'Parsing error occurred while updating product ' + product_id + f': {parse_error}')
@@ -342,103 +781,161 @@ class PSApiWrapper(object):
 
         except Exception as error:
             logging.exception(f'Other error occurred while updating product ' + product_id + f': {error}')
-            if 'Operation timed out' in str(error):
-                if first:
-                    logging.warning('Trying again due to operation timeout...')
-                    self._update(product_id, price, s, first=False)
 
         else:
-            if update_response["product"]["id"] == product_id:
-                if update_response["product"]["price"] == net_price:
-                    logging.debug('Successfully updated product ' + product_id)
-                    if not first:
-                        logging.info("Successfully updated product " + product_id + " after retry!")
+            return self._check_update(update_response, product_id, net_price)
 
-            else:
-                logging.error('Undefined error occurred while updating product ' + product_id)
+        return False
 
-    def _get_ids(self):
-        all_ids = []
+    async def _update_async(self, session, product_id, price):
+        if self.patch_supported is not False:
+            success = await self._update_patch_async(session, product_id, price)
+            if self.patch_supported is not False:
+                return success
 
+        return await self._update_full_async(session, product_id, price)
+
+    async def _update_patch_async(self, session, product_id, price):
         try:
-            check_request = requests.get(self.api_url + 'products?display=[id,ean13]',
-                                         headers={'Authorization': 'Basic ' + self.token,
-                                                  'Output-Format': 'JSON'})
+            net_price = self._net_price(price)
+            update_request = await session.patch(self.api_url + 'products/' + product_id,
+                                                 headers={'Io-Format': 'JSON'},
+                                                 data=self._build_patch_xml(product_id, net_price))
 
-            check_response = check_request.json()
-            check_request.raise_for_status()
-            logging.debug('Sent get all ids request')
+            if self._patch_unsupported(update_request.status):
+                return False
 
-            for product in check_response["products"]:
-                if product["ean13"] == '':
-                    s = [None, str(product["id"])]
-                else:
-                    s = [product["ean13"], str(product["id"]), False]
-                all_ids.append(s)
+            update_response = await update_request.json(content_type=None)
+            update_request.raise_for_status()
+            logging.debug('Sent patch price request')
 
-        except HTTPError as http_error:
-            logging.error(f'HTTP error occurred while getting ids: {http_error}')
+        except aiohttp.ClientResponseError as http_error:
+            logging.exception('HTTP error occurred while updating product ' + product_id + f': {http_error}')
 
         except Exception as error:
-            logging.error(f'Other error occurred while getting ids: {error}')
+            logging.exception(f'Other error occurred while updating product ' + product_id + f': {error}')
 
         else:
-            return all_ids
+            return self._check_update(update_response, product_id, net_price)
 
-    def _merge_all(self, ids, prices):
+        return False
+
+    async def _update_full_async(self, session, product_id, price):
         try:
-            merged = []
-            for stock in prices[:]:
-                if stock[0] is None:
-                    prices.remove(stock)
-                    stock[0] = 'EAN - Allegro'
-                    merged.append([stock[0], stock[2]])
-                    continue
+            get_request = await session.get(self.api_url + 'products/' + product_id)
+            get_response = await get_request.read()
 
-                for product in ids[:]:
-                    if product[0] is None:
-                        ids.remove(product)
-                        product[0] = 'EAN - PS'
-                        merged.append(product)
-                        break
+            net_price = self._net_price(price)
+            update_xml = self._build_update_xml(get_response, net_price)
+
+            get_request.raise_for_status()
+            logging.debug('Sent get xml form request')
 
-                    elif stock[0] == product[0]:
-                        merged.append([product[0], product[1], str(stock[1])])
-                        if not product[2]:
-                            ids.remove(product)
-                            product[2] = True
-                            ids.append(product)
-                        prices.remove(stock)
-                        logging.debug('Successfully merged product: ' + product[0])
+            update_request = await session.put(self.api_url + 'products', headers={'Io-Format': 'JSON'},
+                                               data=update_xml)
+            update_response = await update_request.json(content_type=None)
+            update_request.raise_for_status()
+            logging.debug('Sent update price request')
+
+        except aiohttp.ClientResponseError as http_error:
+            logging.exception('HTTP error occurred while updating product ' + product_id + f': {http_error}')
+
+        except ParseError as parse_error:
+            logging.exception(f'Parsing error occurred while updating product ' + product_id + f': {parse_error}')
+            if 'no element found: line 1, column 0' in str(parse_error):
+                logging.warning('Probably bugged product! Please re-add it.')
+
+        except Exception as error:
+            logging.exception(f'Other error occurred while updating product ' + product_id + f': {error}')
+
+        else:
+            return self._check_update(update_response, product_id, net_price)
+
+        return False
+
+    def _get_catalog_page(self, offset, fields):
+        page_request = self.transport.get(self.api_url + 'products?display=[' + fields + ']&sort=[id_ASC]&limit=' +
+                                          str(offset) + ',' + str(self.catalog_page_size),
+                                          headers={'Output-Format': 'JSON'})
+
+        page_response = page_request.json()
+        page_request.raise_for_status()
+        logging.debug('Fetched catalog page %d-%d', offset, offset + self.catalog_page_size)
+
+        # Prestashop returns an empty list instead of an object past the last product
+        if not page_response:
+            return []
+
+        return [records.PSProduct(product["ean13"] or None, str(product["id"]), product.get("price"))
+                for product in page_response["products"]]
+
+    @metrics.REGISTRY.timed('catalog')
+    def _get_ids(self, with_prices=False):
+        """Loads the catalog into EanIndex, once for all wrappers of the same store if they share catalog_cache"""
+        fields = 'id,ean13,price' if with_prices and self.catalog_prices else 'id,ean13'
+        if self.catalog_cache is None:
+            return self._load_catalog(fields)
+
+        return self.catalog_cache.get(self.api_url, fields, self._load_catalog)
+
+    def _load_catalog(self, fields):
+        """Loads the catalog page by page, fetching several pages at once"""
+        index = matching.EanIndex()
+        pages = {}
+        running = {}
+        offset = 0
+        next_offset = 0
+        last_page = False
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.catalog_concurrency) as executor:
+                while True:
+                    while not last_page and len(running) < self.catalog_concurrency:
+                        running[executor.submit(self._get_catalog_page, offset, fields)] = offset
+                        offset += self.catalog_page_size
+
+                    if not running:
                         break
 
-            if self.content_lang == 'pl':
-                for product in ids:
-                    if not product[2]:
-                        product = ['Niedopasowano PS', product[1]]
-                        merged.append(product)
-                        logging.debug('Mismatched product: ' + product[1])
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        page = future.result()
+                        pages[running.pop(future)] = page
+                        if len(page) < self.catalog_page_size:
+                            last_page = True
 
-                for stock in prices:
-                    stock = ['Niedopasowano Allegro', stock[2]]
-                    merged.append(stock)
-                    logging.debug('Mismatched product: ' + stock[1])
+                    # Pages are indexed in order, so the results keep the order of the catalog
+                    while next_offset in pages:
+                        index.extend(pages.pop(next_offset))
+                        next_offset += self.catalog_page_size
 
-            else:
-                if self.content_lang != 'en':
-                    logging.error(
-                        'Error: Content language "' + self.content_lang + '"is not supported. Using en instead.')
+        except HTTPError as http_error:
+            logging.error(f'HTTP error occurred while getting ids: {http_error}')
 
-                for product in ids:
-                    if not product[2]:
-                        product = ['Mismatched PS', product[1]]
-                        merged.append(product)
-                        logging.debug('Mismatched product: ' + product[1])
+        except Exception as error:
+            logging.error(f'Other error occurred while getting ids: {error}')
 
-                for stock in prices:
-                    stock = ['Mismatched Allegro', stock[2]]
-                    merged.append(stock)
-                    logging.debug('Mismatched product: ' + stock[1])
+        else:
+            logging.debug('Loaded ' + str(len(index)) + ' products from ' + str(next_offset // self.catalog_page_size) +
+                          ' catalog pages')
+            return index
+
+    def _is_unchanged(self, product, pushed):
+        """True if the shop already has the net price
+
+        The price from the catalog is trusted if it was loaded, so prices edited in the shop are put back. The one
+        pushed by the previous run is used otherwise.
+        """
+        net_price = self._net_price(product.price)
+        if product.current_price is not None:
+            return float(product.current_price) == float(net_price)
+
+        return pushed.get(product.product_id) == net_price
+
+    @metrics.REGISTRY.timed('merge')
+    def _merge_all(self, ids, prices):
+        try:
+            merged = matching.merge(ids, prices, self.content_lang)
 
         except Exception as e:
             logging.error('Something went wrong with merging lists: ' + str(e))
@@ -447,74 +944,254 @@ class PSApiWrapper(object):
             logging.info('Successfully merged lists!')
             return merged
 
-    def _send_report(self, updated, not_updated, skipped):
-        str_not_updated = '\n'.join(map(str, list(map(' '.join, not_updated))))
+    @metrics.REGISTRY.timed('report')
+    def _send_report(self, run_report):
+        """Queues the summary with the CSV file of the report attached, the run doesn't wait for the delivery"""
+        for name, value in run_report.values.items():
+            metrics.REGISTRY.set(name, value)
+
+        mail.MAILER.send(self.mail_settings, run_report.summary() + '\n\n' + metrics.REGISTRY.summary(),
+                         [mail.attachment(run_report.file_path)], description='report')
+
+    def _update_all_threaded(self, products):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            for product in products:
+                future = executor.submit(self._update, product_id=product.product_id, price=product.price,
+                                         s=self.transport)
+                futures[future] = product
+
+            progress = logs.Progress('Updates', len(futures), self.progress_interval, self.account)
+            for future in concurrent.futures.as_completed(futures):
+                progress.advance()
+                yield futures[future], future.result()
+
+            progress.finish()
+
+    async def _update_all_async(self, products, emit):
+        """Passes every finished update to emit() as (product, success)"""
+        async with transport.AsyncTransport.from_config(self.config, 'prestashop', pool_size=self.concurrency,
+                                                        headers={'Authorization': 'Basic ' + self.token}) as session:
+            async def update(product):
+                return product, await self._update_async(session, product.product_id, product.price)
+
+            # The first update runs alone, so PATCH support is detected before the others start
+            if products and self.patch_supported is None:
+                emit(await update(products[0]))
+                products = products[1:]
+
+            tasks = [update(product) for product in products]
+            progress = logs.Progress('Updates', len(tasks), self.progress_interval, self.account)
+            for task in asyncio.as_completed(tasks):
+                emit(await task)
+                progress.advance()
+
+            progress.finish()
 
-        if self.content_lang == 'pl':
-            content = 'Zaktualizowane produkty: ' + str(len(updated)) + '\n\nPominięte produkty: \n' \
-                      + str(skipped) + '\n\nNiezaktualizowane produkty:\n' + str_not_updated + '\nRazem: ' \
-                      + str(len(not_updated))
-            logging.debug('Using pl mail template')
+    @staticmethod
+    def _log_coalesced(conflicts, saved):
+        if saved or conflicts:
+            logging.info('Coalescing saved ' + str(saved) + ' price writes, ' + str(len(conflicts)) +
+                         ' products have conflicting prices')
 
-        elif self.content_lang == 'en':
-            content = 'Updated products: ' + str(len(updated)) + '\n\nSkipped products: \n' \
-                      + str(skipped) + '\n\nNot updated products:\n' + str_not_updated + '\nTotal: ' \
-                      + str(len(not_updated))
-            logging.debug('Using en mail template')
+    def plan(self, prices, full=False):
+        """Matches prices with the catalog and leaves one price per product
 
-        else:
-            logging.error('Error: Content language "' + self.content_lang + '"is not supported. Using en instead.')
-            content = 'Updated products: ' + str(len(updated)) + '\n\nSkipped products: \n' \
-                      + str(skipped) + '\n\nNot updated products:\n' + str_not_updated + '\nTotal: ' \
-                      + str(len(not_updated))
+        Returns (products to update, not updatable products, unchanged count, conflicts, writes saved).
+        """
+        not_updated = []
+        candidates = []
+        to_update = []
+        unchanged = 0
 
-        mail_tpl = f'From: {self.user}' + f'\nTo: {self.receiver}' + f'\nSubject: {self.subject}' + f'\n\n{content}'
+        ids = self._get_ids(with_prices=not full)
+        products_params = self._merge_all(ids, prices)
 
-        try:
-            server = smtplib.SMTP_SSL(self.server, self.port)
-            logging.debug('SMTP server connection established')
+        with state.StateStore(self.state_path) as store:
+            pushed = {} if full else store.get_prices()
+            logging.info('Loaded ' + str(len(pushed)) + ' previously pushed prices')
 
-            if self.log_level <= '10':
-                server.set_debuglevel(True)
+        for product in products_params:
+            if not product.updatable:
+                not_updated.append(product)
+            else:
+                candidates.append(product)
 
-            server.ehlo()
-            server.login(self.user, self.passwd)
-            logging.debug('Logged into SMTP server')
-            server.sendmail(self.user, self.receiver.split(', '), mail_tpl.encode('utf-8'))
-            logging.debug('Sent mail')
-            server.close()
-            logging.debug('SMTP server connection closed')
+        # Coalesced before the unchanged ones are skipped, so a price which lost can't be pushed instead
+        candidates, conflicts, saved = self.coalescer.coalesce(candidates)
+        self._log_coalesced(conflicts, saved)
 
-        except Exception as e:
-            logging.error('Something went wrong with mail: ' + str(e))
+        for product in candidates:
+            if self._is_unchanged(product, pushed):
+                unchanged += 1
+            else:
+                to_update.append(product)
+
+        logging.info('Skipping ' + str(unchanged) + ' products with unchanged price')
+
+        return to_update, not_updated, unchanged, conflicts, saved
+
+    def _new_report(self, skipped=0, unchanged=0, saved=0):
+        run_report = report.Report(self.report_path, self.content_lang)
+        run_report.add('skipped', skipped)
+        run_report.add('unchanged', unchanged)
+        run_report.add('writes_saved', saved)
+
+        return run_report
+
+    def apply(self, to_update, not_updated, skipped, unchanged=0, send_report=True, conflicts=(), saved=0):
+        """Pushes planned prices, records the successful ones and sends the report
+
+        Returns the Report of the run, which is only sent if send_report is True.
+        """
+        run_report = self._new_report(skipped, unchanged, saved)
+        for product in not_updated:
+            run_report.not_updated(product)
+
+        for conflict in conflicts:
+            run_report.conflict(conflict)
+
+        with state.StateStore(self.state_path) as store:
+            if self.journal is not None:
+                applied = [product for product in to_update if self.journal.is_applied(product)]
+                to_update = [product for product in to_update if not self.journal.is_applied(product)]
+                logging.info('Skipping ' + str(len(applied)) + ' updates applied by the interrupted run')
+
+                # Their records may have been lost with the interrupted run
+                for product in applied:
+                    store.record(product.product_id, self._net_price(product.price), product.offer_id)
+                    run_report.updated(product, True)
+
+            with metrics.REGISTRY.phase('updates'):
+                for i, (product, success) in enumerate(self.sink.update_all(to_update), 1):
+                    if success:
+                        store.record(product.product_id, self._net_price(product.price), product.offer_id)
+
+                    if self.journal is not None:
+                        self.journal.update(product, success)
+
+                    run_report.updated(product, success)
+                    if i % 1000 == 0:
+                        store.commit()
+
+        run_report.close()
+        if send_report:
+            self._send_report(run_report)
+
+        return run_report
+
+    def update_all(self, prices, skipped, full=False, send_report=True):
+        to_update, not_updated, unchanged, conflicts, saved = self.plan(prices, full)
+        return self.apply(to_update, not_updated, skipped, unchanged, send_report, conflicts, saved)
+
+    def update_stream(self, fetcher, full=False, send_report=True):
+        """Updates prices while they are still being fetched from Allegro, returns the report like apply()
+
+        The first price of a product is pushed right away. Once all prices are known, the products matched
+        by several offers get the price chosen by the coalescer, if it's a different one. The report lists the
+        last write of each product only.
+        """
+        run_report = self._new_report()
+
+        prices = fetcher.iter_prices(self.queue_size)
+        merger = matching.Merger(self._get_ids(with_prices=not full), self.content_lang)
+        logging.info('Loaded ' + str(len(merger.index)) + ' Prestashop products')
+
+        with state.StateStore(self.state_path) as store:
+            pushed = {} if full else store.get_prices()
+            logging.info('Loaded ' + str(len(pushed)) + ' previously pushed prices')
+
+            recorded = 0
+            progress = logs.Progress('Updates', interval=self.progress_interval, account=self.account)
+            # Reported at the end, as the first write of a product may be superseded by the chosen price
+            results = {}
+
+            def record():
+                nonlocal recorded
+                for product, success in self.sink.results():
+                    if success:
+                        store.record(product.product_id, self._net_price(product.price), product.offer_id)
+
+                    if self.journal is not None:
+                        self.journal.update(product, success)
+
+                    results[product.product_id] = (product, success)
+                    recorded += 1
+                    progress.advance()
+                    if recorded % 1000 == 0:
+                        store.commit()
+
+            def push(product):
+                if self.journal is not None and self.journal.is_applied(product):
+                    store.record(product.product_id, self._net_price(product.price), product.offer_id)
+                    results[product.product_id] = (product, True)
+                else:
+                    self.sink.submit(product)
 
-        else:
-            logging.info('Successfully sent report!')
+            candidates = {}
+            with metrics.REGISTRY.phase('updates'):
+                for offer in prices:
+                    for product in merger.match(offer):
+                        if not product.updatable:
+                            run_report.not_updated(product)
 
-    def update_all(self, prices, skipped):
-        updated = []
-        not_updated = []
+                        elif product.product_id in candidates:
+                            candidates[product.product_id].append(product)
 
-        ids = self._get_ids()
-        products_params = self._merge_all(ids, prices)
+                        elif self._is_unchanged(product, pushed):
+                            candidates[product.product_id] = [product]
+                            run_report.add('unchanged', 1)
+
+                        else:
+                            candidates[product.product_id] = [product]
+                            push(product)
 
-        with requests.Session() as s:
-            s.headers.update({'Authorization': 'Basic ' + self.token})
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
-                i = 0
-                NOT_TO_UPDATE = ['EAN - Allegro', 'EAN - PS', 'Mismatched PS', 'Niedopasowano PS', 'Mismatched Allegro',
-                                 'Niedopasowano Allegro']
-                for product in products_params:
-                    if product[0] in NOT_TO_UPDATE:
-                        not_updated.append(product)
+                    record()
 
+                # The first prices are written before the chosen ones, so they can't overwrite them
+                self.sink.flush()
+                record()
+
+                duplicates = [product for products in candidates.values() if len(products) > 1 for product in products]
+                chosen, conflicts, saved = self.coalescer.coalesce(duplicates)
+
+                for product in chosen:
+                    first = candidates[product.product_id][0]
+                    if self._net_price(product.price) == self._net_price(first.price):
+                        continue
+
+                    if self._is_unchanged(first, pushed):
+                        run_report.add('unchanged', -1)
                     else:
-                        futures.append(executor.submit(self._update, product_id=product[1], price=product[2], s=s))
-                        updated.append(product[1])
+                        # Both prices are written
+                        saved -= 1
+
+                    push(product)
+
+                self.sink.flush()
+
+            record()
+            progress.finish()
+
+        for product, success in results.values():
+            run_report.updated(product, success)
+
+        for product in merger.leftovers():
+            run_report.not_updated(product)
+
+        for conflict in conflicts:
+            run_report.conflict(conflict)
+
+        self._log_coalesced(conflicts, saved)
+        run_report.add('skipped', fetcher.skipped)
+        run_report.add('writes_saved', saved)
+        run_report.close()
+
+        if send_report:
+            self._send_report(run_report)
 
-                for _ in concurrent.futures.as_completed(futures):
-                    i += 1
-                    logging.info(str(i) + '/' + str(len(futures)))
+        return run_report
 
-        self._send_report(updated, not_updated, skipped)
+    def close(self):
+        self.sink.close()
+        self.transport.close()
@@ -0,0 +1,170 @@
+import concurrent.futures
+import threading
+import time
+import logging
+from Allegro2Prestashop import records, state
+
+
+OFFER_EVENT_TYPES = ('OFFER_ACTIVATED', 'OFFER_CHANGED', 'OFFER_PRICE_CHANGED')
+EVENTS_LIMIT = 1000
+CURSOR = 'offer_events'
+
+
+class Daemon(object):
+    """Keeps Prestashop prices in sync by following Allegro offer events, with periodic full reconciliation
+
+    Events are polled from the cursor stored in the state store. Only the offers they mention are fetched
+    and their prices are pushed through the price sink of the wrapper. The full sync runs in the background
+    every reconcile_hours, its updates are pushed from the main loop, so the sink is used by one thread only.
+    """
+
+    def __init__(self, fetcher, wrapper, config, on_reconciled=None):
+        self.fetcher = fetcher
+        self.wrapper = wrapper
+        self.on_reconciled = on_reconciled
+
+        self.poll_interval = float(config.get('daemon', 'poll_interval', fallback='10'))
+        self.reconcile_interval = float(config.get('daemon', 'reconcile_hours', fallback='24')) * 3600
+
+        self.stopped = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.reconciliation = None
+        self.reconciliation_cursor = None
+        self.next_reconciliation = 0.0
+
+        self.cursor = None
+        self.pushed = {}
+        self.offer_products = {}
+        self.index = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def _load(self, store):
+        """Loads what the events are matched against - pushed prices, their offers and the catalog"""
+        self.pushed = store.get_prices()
+        self.offer_products = store.get_offer_products()
+        self.index = self.wrapper._get_ids()
+
+    def _skip_to_latest(self):
+        """Returns id of the newest event, the full reconciliation covers everything before it"""
+        cursor = None
+        while True:
+            events = self.fetcher.get_offer_events(cursor, OFFER_EVENT_TYPES, EVENTS_LIMIT)
+            if events:
+                cursor = events[-1]["id"]
+
+            if len(events) < EVENTS_LIMIT:
+                return cursor
+
+    def _reconcile(self, store):
+        """Starts the full sync when it's due and pushes its prices once the fetch is finished"""
+        if self.reconciliation is None and time.time() >= self.next_reconciliation:
+            logging.info('Starting full reconciliation')
+            # The retry budget is per run, every reconciliation gets a whole one
+            self.fetcher.transport.retry_policy.reset()
+            self.wrapper.transport.retry_policy.reset()
+            self.reconciliation_cursor = self.cursor
+            self.reconciliation = self.executor.submit(self.fetcher.get_prices)
+            self.next_reconciliation = time.time() + self.reconcile_interval
+
+        if self.reconciliation is None or not self.reconciliation.done():
+            return
+
+        try:
+            prices, skipped = self.reconciliation.result()
+            self.wrapper.update_all(prices, skipped)
+
+        except Exception as error:
+            logging.exception(f'Error occurred during full reconciliation: {error}')
+
+        else:
+            # Events which arrived during the fetch are replayed, as the listing may predate them
+            self.cursor = self.reconciliation_cursor
+            self._load(store)
+            logging.info('Full reconciliation finished')
+
+            if self.on_reconciled is not None:
+                self.on_reconciled()
+
+        self.reconciliation = None
+
+    def _match(self, offer):
+        """Returns MergeResult per product the offer's price goes to - the ones it was last pushed to, if any"""
+        if offer.ean is None:
+            return []
+
+        product_ids = self.offer_products.get(offer.offer_id)
+        if product_ids is None:
+            product_ids = [product.product_id for product in self.index.match(offer.ean)]
+
+        return [records.MergeResult(ean=offer.ean, product_id=product_id, price=str(offer.price),
+                                    offer_id=offer.offer_id)
+                for product_id in product_ids]
+
+    def _poll(self, store):
+        """Pushes prices of the offers from the next page of events, returns True if there are more of them"""
+        events = self.fetcher.get_offer_events(self.cursor, OFFER_EVENT_TYPES, EVENTS_LIMIT)
+        if not events:
+            return False
+
+        offer_ids = list(dict.fromkeys(event["offer"]["id"] for event in events))
+        matched = []
+
+        for offer in self.fetcher.get_offer_prices(offer_ids):
+            products = self._match(offer)
+            if not products:
+                logging.debug('Mismatched product: %s', offer.offer_id)
+            matched.extend(products)
+
+        # Offers of the same product changed within one page of events are pushed once
+        matched, _, _ = self.wrapper.coalescer.coalesce(matched)
+        to_update = [product for product in matched if not self.wrapper._is_unchanged(product, self.pushed)]
+
+        for product, success in self.wrapper.sink.update_all(to_update):
+            if success:
+                net_price = self.wrapper._net_price(product.price)
+                store.record(product.product_id, net_price, product.offer_id)
+                self.pushed[product.product_id] = net_price
+                product_ids = self.offer_products.setdefault(product.offer_id, [])
+                if product.product_id not in product_ids:
+                    product_ids.append(product.product_id)
+
+        self.cursor = events[-1]["id"]
+        store.record_cursor(CURSOR, self.cursor)
+        store.commit()
+
+        logging.info(str(len(events)) + ' offer events, ' + str(len(to_update)) + ' prices pushed')
+        return len(events) == EVENTS_LIMIT
+
+    def run(self):
+        with state.StateStore(self.wrapper.state_path) as store:
+            self.cursor = store.get_cursor(CURSOR)
+            if self.cursor is None:
+                self.cursor = self._skip_to_latest()
+                if self.cursor is not None:
+                    store.record_cursor(CURSOR, self.cursor)
+                    store.commit()
+
+            self._load(store)
+            logging.info('Daemon started, following offer events from ' + str(self.cursor))
+
+            try:
+                while not self.stopped.is_set():
+                    self._reconcile(store)
+
+                    try:
+                        more = self._poll(store)
+
+                    except Exception as error:
+                        logging.exception(f'Error occurred while processing offer events: {error}')
+                        more = False
+
+                    if not more:
+                        self.stopped.wait(self.poll_interval)
+
+            except KeyboardInterrupt:
+                pass
+
+        self.executor.shutdown(wait=False)
+        logging.info('Daemon stopped')
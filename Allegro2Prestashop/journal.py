@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+import logging
+
+
+class RunJournal(object):
+    """Append-only record of a run - completed listing pages, fetched offers and applied updates
+
+    Lets --resume continue an interrupted run without repeating its network calls. Records are buffered and
+    written with a single write and fsync per batch, a page is flushed as soon as it's completed.
+    """
+
+    def __init__(self, file_path, run, resume=False, batch_size=1000):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.buffer = []
+        self.lock = threading.Lock()
+
+        self.pages = {}
+        self.offers = {}
+        self.updates = set()
+
+        if resume and self._load(run):
+            self.file = open(file_path, 'a')
+            # New records must not be glued to a partially written line left by the interrupted run
+            self.file.truncate(self.loaded_size)
+            logging.info(f'Resuming interrupted run: {len(self.pages)} listing pages, {len(self.offers)} offers '
+                         f'and {len(self.updates)} updates already done')
+        else:
+            self.pages, self.offers, self.updates = {}, {}, set()
+            self.file = open(file_path, 'w')
+            self._append({'t': 'start', 'run': run, 'started': time.time()})
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.close()
+
+    def _load(self, run):
+        """Reads journal of the previous run, returns False if there's nothing to resume"""
+        if not os.path.isfile(self.file_path):
+            logging.info('No run journal found, starting from the beginning')
+            return False
+
+        self.loaded_size = 0
+        with open(self.file_path, 'rb') as infile:
+            for number, line in enumerate(infile):
+                # The interrupted run may have left a partially written line
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                self.loaded_size += len(line)
+
+                if number == 0 and (record.get('t') != 'start' or record.get('run') != run):
+                    logging.warning('Run journal belongs to a different run (' + str(record.get('run')) + '), '
+                                    'starting from the beginning')
+                    return False
+
+                if record['t'] == 'page':
+                    self.pages[record['offset']] = record['total']
+                elif record['t'] == 'offer':
+                    self.offers[record['id']] = (record['detail'], record['price'], record.get('status'))
+                elif record['t'] == 'update' and record['ok']:
+                    self.updates.add((record['id'], record['offer']))
+                elif record['t'] == 'done':
+                    logging.info('The previous run was completed, starting from the beginning')
+                    return False
+
+        return True
+
+    def _append(self, record):
+        self.buffer.append(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.file.write(''.join(self.buffer))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.buffer = []
+
+    def _record(self, record):
+        with self.lock:
+            self._append(record)
+            full = len(self.buffer) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def offer(self, offer_id, detail, price, status=None):
+        self._record({'t': 'offer', 'id': offer_id, 'detail': detail, 'price': price, 'status': status})
+
+    def page(self, offset, total):
+        self._record({'t': 'page', 'offset': offset, 'total': total})
+        self.flush()
+
+    def update(self, product, success):
+        self._record({'t': 'update', 'id': product.product_id, 'offer': product.offer_id, 'ok': success})
+
+    def is_applied(self, product):
+        return (product.product_id, product.offer_id) in self.updates
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def finish(self):
+        """Marks the run as completed, so it won't be resumed"""
+        self._record({'t': 'done', 'finished': time.time()})
+        self.close()
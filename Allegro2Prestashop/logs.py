@@ -0,0 +1,104 @@
+import atexit
+import copy
+import json
+import queue
+import threading
+import time
+import logging
+import logging.handlers
+
+
+TEXT_FORMAT = "%(asctime)s  — %(levelname)s — %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors"""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Queues records with their exception info, so tracebacks are formatted by the listener thread
+
+    Only the message is rendered right away, as its arguments may change once the record is queued.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+def setup(config, filemode='w'):
+    """Logs through a queue, so the threads doing requests never wait for the log file
+
+    The records are written by a listener thread, which is stopped (and the queue flushed) at exit.
+    """
+    handler = logging.FileHandler('logs/app.log', mode=filemode, encoding='utf-8')
+    if config.get('log', 'format', fallback='text') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(int(config['log']['log_level']))
+
+    return listener
+
+
+class Progress(object):
+    """Counts processed items and logs at most one summary with throughput and ETA per interval
+
+    The summaries are prefixed with the account name, if it's given.
+    """
+
+    def __init__(self, name, total=None, interval=10.0, account=None):
+        self.name = name if account is None else '[' + account + '] ' + name
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+        self.lock = threading.Lock()
+
+    def advance(self, count=1):
+        with self.lock:
+            self.count += count
+            now = time.monotonic()
+            if now - self.reported < self.interval:
+                return
+
+            self.reported = now
+
+        self._report(now)
+
+    def _report(self, now, final=False):
+        elapsed = now - self.started
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+
+        if final:
+            logging.info('%s: %d done in %.1f s (%.1f/s)', self.name, self.count, elapsed, rate)
+
+        elif self.total and rate > 0:
+            logging.info('%s: %d/%d (%.0f%%), %.1f/s, ETA %.0f s', self.name, self.count, self.total,
+                         100.0 * self.count / self.total, rate, max(0, self.total - self.count) / rate)
+
+        else:
+            logging.info('%s: %d, %.1f/s', self.name, self.count, rate)
+
+    def finish(self):
+        self._report(time.monotonic(), final=True)
@@ -0,0 +1,118 @@
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+import logging
+from email.message import EmailMessage
+
+
+class MailSettings(object):
+    """SMTP account, receivers and subject of one kind of mail, read from a section of the config file"""
+
+    def __init__(self, config, section):
+        self.receiver = config[section]['receiver']
+        self.subject = config[section]['subject']
+        self.user = config[section]['user']
+        self.passwd = config[section]['passwd']
+        self.server = config[section]['server']
+        self.port = int(config[section]['port'])
+
+        self.debug = int(config['log']['log_level']) <= 10
+        self.attempts = int(config.get(section, 'delivery_attempts', fallback='3'))
+        self.retry_delay = float(config.get(section, 'retry_delay', fallback='30'))
+
+
+class Mailer(object):
+    """Delivers mails in a background thread, so the run never waits on SMTP
+
+    Failed deliveries are retried with exponential backoff. Mails still queued at exit are delivered
+    before the process ends.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, settings, content, attachments=(), description='mail'):
+        """Queues the mail, attachments are (file name, path) pairs read when the mail is sent"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='Mailer', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+        self.queue.put((settings, content, list(attachments), description))
+
+    def flush(self):
+        """Waits until every queued mail is delivered or given up"""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            try:
+                self._deliver(*message)
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _build(settings, content, attachments):
+        message = EmailMessage()
+        message['From'] = settings.user
+        message['To'] = settings.receiver
+        message['Subject'] = settings.subject
+        message.set_content(content)
+
+        for file_name, file_path in attachments:
+            with open(file_path, 'rb') as infile:
+                message.add_attachment(infile.read(), maintype='application', subtype='gzip', filename=file_name)
+
+        return message
+
+    def _deliver(self, settings, content, attachments, description):
+        try:
+            message = self._build(settings, content, attachments)
+
+        except Exception as error:
+            logging.error('Something went wrong with mail: ' + str(error))
+            return
+
+        for attempt in range(1, settings.attempts + 1):
+            try:
+                server = smtplib.SMTP_SSL(settings.server, settings.port, timeout=60)
+                logging.debug('SMTP server connection established')
+
+                if settings.debug:
+                    server.set_debuglevel(True)
+
+                server.ehlo()
+                server.login(settings.user, settings.passwd)
+                logging.debug('Logged into SMTP server')
+                server.send_message(message, settings.user, settings.receiver.split(', '))
+                logging.debug('Sent mail')
+                server.quit()
+                logging.debug('SMTP server connection closed')
+
+            except Exception as error:
+                if attempt == settings.attempts:
+                    logging.error('Something went wrong with mail: ' + str(error) + '. Giving up the ' + description +
+                                  ' after ' + str(attempt) + ' attempts.')
+                    return
+
+                delay = settings.retry_delay * 2 ** (attempt - 1)
+                logging.warning(f'Sending {description} failed ({error}), retrying in {delay:.1f} s')
+                time.sleep(delay)
+
+            else:
+                logging.info('Successfully sent ' + description + '!')
+                return
+
+
+def attachment(file_path):
+    return os.path.basename(file_path), file_path
+
+
+MAILER = Mailer()
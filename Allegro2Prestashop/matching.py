@@ -0,0 +1,190 @@
+import logging
+from Allegro2Prestashop.records import Conflict, MergeResult
+
+
+LABELS = {
+    'en': {'allegro_ean': 'EAN - Allegro', 'ps_ean': 'EAN - PS',
+           'ps': 'Mismatched PS', 'allegro': 'Mismatched Allegro'},
+    'pl': {'allegro_ean': 'EAN - Allegro', 'ps_ean': 'EAN - PS',
+           'ps': 'Niedopasowano PS', 'allegro': 'Niedopasowano Allegro'},
+}
+
+# Which of several prices of the same Prestashop product is pushed
+COALESCE_RULES = ('lowest', 'active')
+
+
+def normalize_ean(ean):
+    """Returns EAN13 in canonical form or None if it's empty"""
+    if ean is None:
+        return None
+
+    ean = str(ean).strip()
+    if not ean:
+        return None
+
+    if ean.isdigit() and len(ean) < 13:
+        ean = ean.zfill(13)
+
+    return ean
+
+
+def get_labels(content_lang):
+    if content_lang not in LABELS:
+        logging.error('Error: Content language "' + content_lang + '"is not supported. Using en instead.')
+        return LABELS['en']
+
+    return LABELS[content_lang]
+
+
+class EanIndex(object):
+    """Multimap of normalized EAN13 to PSProduct records, filled page by page by _get_ids"""
+
+    def __init__(self, ids=()):
+        self.buckets = {}
+        self.missing = []
+        self.products = []
+
+        self.extend(ids)
+
+    def __len__(self):
+        return len(self.products)
+
+    def add(self, product):
+        self.products.append(product)
+        ean = normalize_ean(product.ean)
+
+        if ean is None:
+            self.missing.append(product)
+        else:
+            self.buckets.setdefault(ean, []).append(product)
+
+    def extend(self, ids):
+        for product in ids:
+            self.add(product)
+
+    def match(self, ean):
+        """Returns all products with given EAN, empty list if there are none"""
+        bucket = self.buckets.get(normalize_ean(ean), [])
+        for product in bucket:
+            product.matched = True
+
+        return bucket
+
+    def unmatched(self):
+        for product in self.products:
+            if product.ean is not None and not product.matched:
+                yield product
+
+
+class Merger(object):
+    """Matches Allegro prices against EanIndex one by one, as they arrive"""
+
+    def __init__(self, index, content_lang='en'):
+        self.index = index if isinstance(index, EanIndex) else EanIndex(index)
+        self.labels = get_labels(content_lang)
+
+    def match(self, offer):
+        """Returns list of MergeResult for the Offer, one per product with its EAN or a single labeled one
+
+        Products sharing an EAN are all matched, so the coalescer gives each of them the same price.
+        """
+        if offer.ean is None:
+            return [MergeResult(self.labels['allegro_ean'], offer_id=offer.offer_id)]
+
+        products = self.index.match(offer.ean)
+        if not products:
+            logging.debug('Mismatched product: %s', offer.offer_id)
+            return [MergeResult(self.labels['allegro'], ean=offer.ean, offer_id=offer.offer_id)]
+
+        logging.debug('Successfully merged product: %s', offer.ean)
+        return [MergeResult(ean=product.ean, product_id=product.product_id, price=str(offer.price),
+                            offer_id=offer.offer_id, current_price=product.price, active=offer.active)
+                for product in products]
+
+    def leftovers(self):
+        """Yields Prestashop products which can't be updated - without EAN or not matched with any price"""
+        for product in self.index.missing:
+            yield MergeResult(self.labels['ps_ean'], product_id=product.product_id)
+
+        for product in self.index.unmatched():
+            logging.debug('Mismatched product: %s', product.product_id)
+            yield MergeResult(self.labels['ps'], ean=product.ean, product_id=product.product_id)
+
+
+def merge(ids, prices, content_lang='en'):
+    """Matches Allegro offers with Prestashop products in a single pass, returns list of MergeResult"""
+    merger = Merger(ids, content_lang)
+    merged = []
+    mismatched = []
+
+    for offer in prices:
+        results = merger.match(offer)
+        if results[0].label == merger.labels['allegro']:
+            mismatched.extend(results)
+        else:
+            merged.extend(results)
+
+    merged.extend(merger.leftovers())
+    merged.extend(mismatched)
+
+    return merged
+
+
+class Coalescer(object):
+    """Collapses several price writes of the same Prestashop product into one
+
+    The offer pinned to the product wins, then (with the active rule) active offers and then the lowest price.
+    Ties are broken by offer id, so the chosen price never depends on the order of the offers.
+    """
+
+    def __init__(self, rule='lowest', pinned=None):
+        self.rule = rule
+        self.pinned = pinned or {}
+
+    @classmethod
+    def from_config(cls, config):
+        rule = config.get('coalesce', 'rule', fallback='lowest')
+        if rule not in COALESCE_RULES:
+            logging.error('Error: Coalescing rule "' + rule + '" is not supported. Using lowest instead.')
+            rule = 'lowest'
+
+        pinned = {}
+        for entry in config.get('coalesce', 'pinned', fallback='').split(','):
+            product_id, _, offer_id = entry.partition('=')
+            if offer_id.strip():
+                pinned[product_id.strip()] = offer_id.strip()
+
+        return cls(rule, pinned)
+
+    def _key(self, product):
+        return (product.offer_id != self.pinned.get(product.product_id),
+                self.rule == 'active' and product.active is False,
+                float(product.price), product.offer_id)
+
+    def choose(self, candidates):
+        return min(candidates, key=self._key)
+
+    def coalesce(self, products):
+        """Returns (one MergeResult per product id in the order of their first writes, conflicts, writes saved)
+
+        Only products whose offers have different prices are reported as conflicts.
+        """
+        groups = {}
+        for product in products:
+            groups.setdefault(product.product_id, []).append(product)
+
+        chosen = []
+        conflicts = []
+        for candidates in groups.values():
+            if len(candidates) == 1:
+                chosen.append(candidates[0])
+                continue
+
+            product = self.choose(candidates)
+            chosen.append(product)
+
+            if len({float(candidate.price) for candidate in candidates}) > 1:
+                conflicts.append(Conflict(product, [candidate for candidate in candidates if candidate is not product]))
+                logging.debug('Conflicting prices: %s', conflicts[-1])
+
+        return chosen, conflicts, len(products) - len(chosen)
@@ -0,0 +1,207 @@
+import json
+import os
+import re
+import threading
+import time
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlsplit
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = 'allegro2prestashop_'
+
+
+def endpoint_name(method, url):
+    """Returns METHOD host/path with ids replaced by {id}, e.g. GET api.allegro.pl/sale/offers/{id}"""
+    url = urlsplit(str(url))
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', url.path)
+
+    return method + ' ' + url.netloc + path
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns upper bound of the bucket containing q-th quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return float('inf')
+
+
+class Metrics(object):
+    """Per-run phase timings, request statistics and counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.requests = {}
+            self.latencies = {}
+            self.retries = {}
+            self.bytes = {}
+            self.values = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def timed(self, name):
+        """Decorator recording wall time of the function as phase"""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe_request(self, endpoint, status, latency, sent=0, received=0):
+        with self.lock:
+            key = (endpoint, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = Histogram()
+            self.latencies[endpoint].observe(latency)
+
+            sent_key, received_key = (endpoint, 'sent'), (endpoint, 'received')
+            self.bytes[sent_key] = self.bytes.get(sent_key, 0) + sent
+            self.bytes[received_key] = self.bytes.get(received_key, 0) + received
+
+    def count_retry(self, endpoint, kind):
+        with self.lock:
+            key = (endpoint, kind)
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, histogram in self.latencies.items():
+                endpoints[endpoint] = {
+                    'requests': {status: count for (name, status), count in self.requests.items()
+                                 if name == endpoint},
+                    'retries': {kind: count for (name, kind), count in self.retries.items() if name == endpoint},
+                    'latency': {'sum': histogram.total, 'count': histogram.count,
+                                'p50': histogram.quantile(0.5), 'p99': histogram.quantile(0.99),
+                                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                                                    histogram.counts))},
+                    'bytes_sent': self.bytes.get((endpoint, 'sent'), 0),
+                    'bytes_received': self.bytes.get((endpoint, 'received'), 0),
+                }
+
+            return {'started': self.started, 'finished': time.time(), 'phases': dict(self.phases),
+                    'endpoints': endpoints, 'values': dict(self.values)}
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = [f'# TYPE {PREFIX}last_run_timestamp_seconds gauge',
+                 f'{PREFIX}last_run_timestamp_seconds {data["finished"]}',
+                 f'# TYPE {PREFIX}phase_seconds gauge']
+        lines.extend(f'{PREFIX}phase_seconds{{phase="{name}"}} {value}' for name, value in data['phases'].items())
+
+        lines.append(f'# TYPE {PREFIX}products gauge')
+        lines.extend(f'{PREFIX}products{{state="{name}"}} {value}' for name, value in data['values'].items())
+
+        lines.append(f'# TYPE {PREFIX}requests_total counter')
+        for endpoint, stats in data['endpoints'].items():
+            for status, count in stats['requests'].items():
+                lines.append(f'{PREFIX}requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+        lines.append(f'# TYPE {PREFIX}retries_total counter')
+        for endpoint, stats in data['endpoints'].items():
+            for kind, count in stats['retries'].items():
+                lines.append(f'{PREFIX}retries_total{{endpoint="{endpoint}",kind="{kind}"}} {count}')
+
+        lines.append(f'# TYPE {PREFIX}bytes_total counter')
+        for endpoint, stats in data['endpoints'].items():
+            lines.append(f'{PREFIX}bytes_total{{endpoint="{endpoint}",direction="sent"}} {stats["bytes_sent"]}')
+            lines.append(f'{PREFIX}bytes_total{{endpoint="{endpoint}",direction="received"}} '
+                         f'{stats["bytes_received"]}')
+
+        lines.append(f'# TYPE {PREFIX}request_duration_seconds histogram')
+        for endpoint, stats in data['endpoints'].items():
+            cumulative = 0
+            for bound, count in stats['latency']['buckets'].items():
+                cumulative += count
+                lines.append(f'{PREFIX}request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{PREFIX}request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats["latency"]["sum"]}')
+            lines.append(f'{PREFIX}request_duration_seconds_count{{endpoint="{endpoint}"}} '
+                         f'{stats["latency"]["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Returns short plain text summary for the report mail"""
+        data = self.to_dict()
+        lines = ['Phases:']
+        lines.extend(f'  {name}: {value:.1f} s' for name, value in data['phases'].items())
+
+        lines.append('Requests:')
+        for endpoint, stats in sorted(data['endpoints'].items()):
+            lines.append(f'  {endpoint}: {stats["latency"]["count"]} requests, '
+                         f'{sum(stats["retries"].values())} retries, p50 <= {stats["latency"]["p50"]} s, '
+                         f'p99 <= {stats["latency"]["p99"]} s, {stats["bytes_received"] // 1024} KiB received')
+
+        return '\n'.join(lines)
+
+    def export(self, json_path=None, prometheus_path=None):
+        """Writes metrics files atomically, so the collectors never read a partial file"""
+        try:
+            if json_path:
+                write_atomic(json_path, json.dumps(self.to_dict(), indent=2))
+
+            if prometheus_path:
+                write_atomic(prometheus_path, self.to_prometheus())
+
+        except Exception as error:
+            logging.error(f'Error while exporting metrics: {error}')
+
+        else:
+            logging.debug('Metrics exported')
+
+
+def write_atomic(file_path, content):
+    temporary = file_path + '.tmp'
+    with open(temporary, 'w') as outfile:
+        outfile.write(content)
+
+    os.replace(temporary, file_path)
+
+
+REGISTRY = Metrics()
@@ -0,0 +1,70 @@
+import argparse
+import gzip
+import json
+import os
+import time
+import logging
+from Allegro2Prestashop.records import MergeResult
+
+
+VERSION = 1
+
+
+def parse_shard(value):
+    """Parses --shard i/N, where 1 <= i <= N"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be in i/N form, e.g. 1/4')
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard index must be between 1 and ' + str(count))
+
+    return index, count
+
+
+def in_shard(product_id, shard):
+    """Products are split by id, so all changes of a product always land in the same shard"""
+    if shard is None:
+        return True
+
+    index, count = shard
+    return int(product_id) % count == index - 1
+
+
+def write_plan(file_path, changes, not_updated, skipped, unchanged, net_price, conflicts=(), saved=0):
+    """Writes gzipped JSON lines - a header and one [product id, net price, old price, offer id, price] per change
+
+    Old price is the shop price known when planning or None.
+    """
+    header = {'version': VERSION, 'created': time.time(), 'changes': len(changes), 'skipped': skipped,
+              'unchanged': unchanged, 'not_updated': [str(product) for product in not_updated],
+              'conflicts': [str(conflict) for conflict in conflicts], 'saved': saved}
+
+    temporary = file_path + '.tmp'
+    with gzip.open(temporary, 'wt', encoding='utf-8') as outfile:
+        outfile.write(json.dumps(header) + '\n')
+        for product in changes:
+            outfile.write(json.dumps([product.product_id, net_price(product.price), product.current_price,
+                                      product.offer_id, product.price]) + '\n')
+
+    os.replace(temporary, file_path)
+    logging.info('Plan of ' + str(len(changes)) + ' price changes written to ' + file_path)
+
+
+def read_plan(file_path, shard=None):
+    """Returns plan header and list of MergeResult to push, only the ones in shard if it's given"""
+    with gzip.open(file_path, 'rt', encoding='utf-8') as infile:
+        header = json.loads(next(infile))
+        if header.get('version') != VERSION:
+            raise RuntimeError('Unsupported plan version: ' + str(header.get('version')))
+
+        changes = []
+        for line in infile:
+            product_id, _, old_price, offer_id, price = json.loads(line)
+            if in_shard(product_id, shard):
+                changes.append(MergeResult(product_id=product_id, price=price, offer_id=offer_id,
+                                           current_price=old_price))
+
+    logging.info('Loaded ' + str(len(changes)) + ' of ' + str(header['changes']) + ' planned price changes')
+    return header, changes
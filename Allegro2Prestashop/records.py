@@ -0,0 +1,78 @@
+class Offer(object):
+    """Priced Allegro offer, ean is None when the offer has no EAN parameter
+
+    active is None when the publication status of the offer is unknown.
+    """
+
+    __slots__ = ('ean', 'price', 'offer_id', 'active')
+
+    def __init__(self, ean, price, offer_id, active=None):
+        self.ean = ean
+        self.price = price
+        self.offer_id = offer_id
+        self.active = active
+
+    def __repr__(self):
+        return f'Offer({self.ean!r}, {self.price!r}, {self.offer_id!r}, {self.active!r})'
+
+
+class PSProduct(object):
+    """Prestashop product from the catalog, ean is None when the product has no EAN13
+
+    price (net) is None unless it was requested from the webservice
+    """
+
+    __slots__ = ('ean', 'product_id', 'price', 'matched')
+
+    def __init__(self, ean, product_id, price=None):
+        self.ean = ean
+        self.product_id = product_id
+        self.price = price
+        self.matched = False
+
+    def __repr__(self):
+        return f'PSProduct({self.ean!r}, {self.product_id!r}, {self.price!r})'
+
+
+class MergeResult(object):
+    """Outcome of matching - a price to push or, when label is set, the reason why it can't be pushed"""
+
+    __slots__ = ('label', 'ean', 'product_id', 'price', 'offer_id', 'current_price', 'active')
+
+    def __init__(self, label=None, ean=None, product_id=None, price=None, offer_id=None, current_price=None,
+                 active=None):
+        self.label = label
+        self.ean = ean
+        self.product_id = product_id
+        self.price = price
+        self.offer_id = offer_id
+        self.current_price = current_price
+        self.active = active
+
+    def __repr__(self):
+        return (f'MergeResult({self.label!r}, {self.ean!r}, {self.product_id!r}, {self.price!r}, {self.offer_id!r}, '
+                f'{self.current_price!r}, {self.active!r})')
+
+    def __str__(self):
+        return (self.label or self.ean) + ' ' + (self.product_id or self.offer_id)
+
+    @property
+    def updatable(self):
+        return self.label is None
+
+
+class Conflict(object):
+    """Prestashop product matched by several Allegro offers with different prices, only the chosen one is pushed"""
+
+    __slots__ = ('chosen', 'rejected')
+
+    def __init__(self, chosen, rejected):
+        self.chosen = chosen
+        self.rejected = rejected
+
+    def __repr__(self):
+        return f'Conflict({self.chosen!r}, {self.rejected!r})'
+
+    def __str__(self):
+        return self.chosen.product_id + ': ' + ', '.join(product.offer_id + ' (' + str(product.price) + ')'
+                                                         for product in [self.chosen] + self.rejected)
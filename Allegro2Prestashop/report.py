@@ -0,0 +1,75 @@
+import csv
+import gzip
+import os
+import logging
+
+
+FIELDS = ('status', 'product_id', 'ean', 'offer_id', 'price', 'detail')
+
+TEMPLATES = {
+    'en': ('Updated products: {updated}\nFailed updates: {failed}\nUnchanged products: {unchanged}\n'
+           'Skipped products: {skipped}\nNot updated products: {not_updated}\nConflicting prices: {conflicts}\n'
+           'Writes saved: {writes_saved}\n\nStatus of every product is in the attached {attachment} file.'),
+    'pl': ('Zaktualizowane produkty: {updated}\nNieudane aktualizacje: {failed}\nNiezmienione produkty: {unchanged}\n'
+           'Pominięte produkty: {skipped}\nNiezaktualizowane produkty: {not_updated}\n'
+           'Różne ceny produktu: {conflicts}\nZaoszczędzone zapisy: {writes_saved}\n\n'
+           'Status każdego produktu znajduje się w załączonym pliku {attachment}.'),
+}
+
+
+class Report(object):
+    """Results of a run - counts for the mail and a row per product streamed into a gzipped CSV file
+
+    The file is complete once close() is called, until then it's written under a temporary name.
+    """
+
+    def __init__(self, file_path, content_lang='en'):
+        self.file_path = file_path
+        self.content_lang = content_lang
+        self.values = dict.fromkeys(('updated', 'failed', 'unchanged', 'skipped', 'not_updated', 'conflicts',
+                                     'writes_saved'), 0)
+
+        self.file = gzip.open(file_path + '.tmp', 'wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(FIELDS)
+
+    def updated(self, product, success):
+        key = 'updated' if success else 'failed'
+        self.values[key] += 1
+        self.writer.writerow((key, product.product_id, product.ean or '', product.offer_id or '', product.price, ''))
+
+    def not_updated(self, product):
+        """Adds a MergeResult with the reason in its label, or its text if it was read from the plan file"""
+        self.values['not_updated'] += 1
+        if isinstance(product, str):
+            self.writer.writerow(('not_updated', '', '', '', '', product))
+        else:
+            self.writer.writerow(('not_updated', product.product_id or '', product.ean or '', product.offer_id or '',
+                                  '', product.label))
+
+    def conflict(self, conflict):
+        """Adds a Conflict, or its text if it was read from the plan file"""
+        self.values['conflicts'] += 1
+        if isinstance(conflict, str):
+            self.writer.writerow(('conflict', conflict.partition(':')[0], '', '', '', conflict))
+        else:
+            chosen = conflict.chosen
+            self.writer.writerow(('conflict', chosen.product_id, chosen.ean or '', chosen.offer_id, chosen.price,
+                                  ', '.join(product.offer_id + ' (' + str(product.price) + ')'
+                                            for product in conflict.rejected)))
+
+    def add(self, name, count):
+        self.values[name] += count
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            os.replace(self.file_path + '.tmp', self.file_path)
+
+    def summary(self):
+        template = TEMPLATES.get(self.content_lang)
+        if template is None:
+            logging.error('Error: Content language "' + self.content_lang + '"is not supported. Using en instead.')
+            template = TEMPLATES['en']
+
+        return template.format(attachment=os.path.basename(self.file_path), **self.values)
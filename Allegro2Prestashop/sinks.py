@@ -0,0 +1,246 @@
+import asyncio
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from Allegro2Prestashop import logs
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+
+def get_sink(wrapper, config):
+    """Returns price sink selected in the config file, webservice if it's unknown or unavailable"""
+    mode = config.get('engine', 'sink', fallback='webservice')
+
+    if mode == 'database':
+        driver = config.get('database', 'driver', fallback='sqlite')
+        if driver == 'mysql' and pymysql is None:
+            logging.error('Error: MySQL database sink requires pymysql package. Using webservice instead.')
+        elif driver not in ('sqlite', 'mysql'):
+            logging.error('Error: Database driver "' + driver + '" is not supported. Using webservice instead.')
+        else:
+            return DatabaseSink.from_config(wrapper, config)
+
+    elif mode != 'webservice':
+        logging.error('Error: Price sink "' + mode + '" is not supported. Using webservice instead.')
+
+    return WebserviceSink(wrapper)
+
+
+class PriceSink(object):
+    """Destination of the new prices
+
+    update_all() writes a known list of products, submit()/results()/flush() are used in --stream mode.
+    Both report every product as (product, success).
+    """
+
+    def __init__(self):
+        self.finished = deque()
+
+    def update_all(self, products):
+        raise NotImplementedError
+
+    def submit(self, product):
+        raise NotImplementedError
+
+    def results(self):
+        """Yields updates finished since the last call"""
+        while self.finished:
+            yield self.finished.popleft()
+
+    def flush(self):
+        """Waits until every submitted product is written"""
+
+    def close(self):
+        self.flush()
+
+
+class WebserviceSink(PriceSink):
+    """Updates products one by one through Prestashop webservice, with the engine set in the config file"""
+
+    def __init__(self, wrapper):
+        super().__init__()
+        self.wrapper = wrapper
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(wrapper.queue_size)
+
+    def update_all(self, products):
+        if self.wrapper.engine == 'async':
+            return self._update_all_async(products)
+
+        return self.wrapper._update_all_threaded(products)
+
+    def _update_all_async(self, products):
+        """Runs the event loop in its own thread and yields the updates as they finish"""
+        results = queue.Queue()
+        done = object()
+        errors = []
+
+        def run():
+            try:
+                asyncio.run(self.wrapper._update_all_async(products, results.put))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                results.put(done)
+
+        loop = threading.Thread(target=run, name='Updates', daemon=True)
+        loop.start()
+
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            yield result
+
+        loop.join()
+        if errors:
+            raise errors[0]
+
+    def submit(self, product):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.wrapper.concurrency)
+
+        def on_done(future):
+            self.finished.append((product, future.result()))
+            self.slots.release()
+
+        self.slots.acquire()
+        future = self.executor.submit(self.wrapper._update, product_id=product.product_id, price=product.price,
+                                      s=self.wrapper.transport)
+        future.add_done_callback(on_done)
+
+    def flush(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+class DatabaseSink(PriceSink):
+    """Writes net prices straight into ps_product and ps_product_shop tables, in batches
+
+    Every batch is a single transaction. Callables added by add_hook() get the ids of the updated products
+    after each committed batch, e.g. to clear the shop cache.
+    """
+
+    def __init__(self, wrapper, connection, paramstyle='?', prefix='ps_', shop_ids=(), batch_size=500,
+                 invalidate_url=None):
+        super().__init__()
+        self.wrapper = wrapper
+        self.connection = connection
+        self.paramstyle = paramstyle
+        self.prefix = prefix
+        self.shop_ids = [int(shop_id) for shop_id in shop_ids]
+        self.batch_size = batch_size
+        self.pending = []
+        self.hooks = []
+
+        if invalidate_url:
+            self.add_hook(lambda product_ids: self._request_invalidation(invalidate_url, product_ids))
+
+    @classmethod
+    def from_config(cls, wrapper, config):
+        driver = config.get('database', 'driver', fallback='sqlite')
+
+        if driver == 'mysql':
+            connection = pymysql.connect(host=config.get('database', 'host', fallback='localhost'),
+                                         port=int(config.get('database', 'port', fallback='3306')),
+                                         user=config.get('database', 'user', fallback=''),
+                                         password=config.get('database', 'passwd', fallback=''),
+                                         database=config.get('database', 'name', fallback=''),
+                                         autocommit=False)
+            paramstyle = '%s'
+        else:
+            connection = sqlite3.connect(config.get('database', 'path', fallback='conf/prestashop.db'), timeout=60)
+            paramstyle = '?'
+
+        shop_ids = [shop_id.strip() for shop_id in config.get('database', 'shop_ids', fallback='').split(',')
+                    if shop_id.strip()]
+
+        logging.debug('Database price sink connected: ' + driver)
+
+        return cls(wrapper, connection, paramstyle,
+                   prefix=config.get('database', 'prefix', fallback='ps_'),
+                   shop_ids=shop_ids,
+                   batch_size=int(config.get('database', 'batch_size', fallback='500')),
+                   invalidate_url=config.get('database', 'invalidate_url', fallback='') or None)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _request_invalidation(self, url, product_ids):
+        response = self.wrapper.transport.post(url, data={'ids': ','.join(product_ids)})
+        response.raise_for_status()
+
+    def _write(self, products):
+        """Writes one batch in a single transaction, returns list of (product, success)"""
+        param = self.paramstyle
+        rows = {}
+        for product in products:
+            rows[int(product.product_id)] = self.wrapper._net_price(product.price)
+
+        updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        shops = ''
+        if self.shop_ids:
+            shops = ' AND id_shop IN (' + ', '.join(str(shop_id) for shop_id in self.shop_ids) + ')'
+
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT id_product FROM ' + self.prefix + 'product WHERE id_product IN (' +
+                           ', '.join([param] * len(rows)) + ')', list(rows))
+            existing = {str(row[0]) for row in cursor.fetchall()}
+
+            values = [(net_price, updated_at, product_id) for product_id, net_price in rows.items()
+                      if str(product_id) in existing]
+            cursor.executemany('UPDATE ' + self.prefix + 'product SET price = ' + param + ', date_upd = ' + param +
+                               ' WHERE id_product = ' + param, values)
+            cursor.executemany('UPDATE ' + self.prefix + 'product_shop SET price = ' + param + ', date_upd = ' +
+                               param + ' WHERE id_product = ' + param + shops, values)
+            self.connection.commit()
+
+        except Exception as error:
+            self.connection.rollback()
+            logging.exception(f'Error occurred while writing batch of {len(products)} prices: {error}')
+            return [(product, False) for product in products]
+
+        for product in products:
+            if product.product_id not in existing:
+                logging.error('Product ' + product.product_id + ' not found in the database')
+
+        for hook in self.hooks:
+            try:
+                hook(sorted(existing, key=int))
+            except Exception as error:
+                logging.error(f'Cache invalidation hook failed: {error}')
+
+        logging.debug('Wrote batch of %d prices', len(existing))
+        return [(product, product.product_id in existing) for product in products]
+
+    def update_all(self, products):
+        progress = logs.Progress('Updates', len(products), self.wrapper.progress_interval, self.wrapper.account)
+        for i in range(0, len(products), self.batch_size):
+            batch = products[i:i + self.batch_size]
+            yield from self._write(batch)
+            progress.advance(len(batch))
+
+        progress.finish()
+
+    def submit(self, product):
+        self.pending.append(product)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.finished.extend(self._write(self.pending))
+            self.pending = []
+
+    def close(self):
+        super().close()
+        self.connection.close()
@@ -0,0 +1,94 @@
+import sqlite3
+import time
+import logging
+
+
+class StateStore(object):
+    """Local SQLite store of the last prices pushed to Prestashop, the cached Allegro offer details and
+    the position in Allegro offer events feed"""
+
+    def __init__(self, db_path='conf/state.db'):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.pending_prices = []
+        self.pending_offers = []
+        self.pending_cursors = []
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prices ('
+                                'product_id TEXT PRIMARY KEY, '
+                                'net_price TEXT NOT NULL, '
+                                'offer_id TEXT, '
+                                'updated_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS offers ('
+                                'offer_id TEXT PRIMARY KEY, '
+                                'marker TEXT NOT NULL, '
+                                'ean TEXT, '
+                                'external_id TEXT, '
+                                'fetched_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cursors ('
+                                'name TEXT PRIMARY KEY, '
+                                'value TEXT NOT NULL, '
+                                'updated_at REAL NOT NULL)')
+        self.connection.commit()
+
+        logging.debug('State store opened: ' + db_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_prices(self):
+        """Returns dict of product id -> last pushed net price"""
+        return dict(self.connection.execute('SELECT product_id, net_price FROM prices'))
+
+    def get_offer_products(self):
+        """Returns dict of offer id -> ids of the products its price was last pushed to"""
+        offer_products = {}
+        for offer_id, product_id in self.connection.execute('SELECT offer_id, product_id FROM prices '
+                                                            'WHERE offer_id IS NOT NULL'):
+            offer_products.setdefault(offer_id, []).append(product_id)
+
+        return offer_products
+
+    def record(self, product_id, net_price, offer_id):
+        self.pending_prices.append((product_id, net_price, offer_id, time.time()))
+
+    def get_offers(self, max_age=None):
+        """Returns dict of offer id -> (marker, ean, external id) fetched not earlier than max_age seconds ago"""
+        oldest = time.time() - max_age if max_age else 0
+        rows = self.connection.execute('SELECT offer_id, marker, ean, external_id FROM offers WHERE fetched_at >= ?',
+                                       (oldest,))
+
+        return {row[0]: row[1:] for row in rows}
+
+    def record_offer(self, offer_id, marker, ean, external_id):
+        self.pending_offers.append((offer_id, marker, ean, external_id, time.time()))
+
+    def get_cursor(self, name):
+        row = self.connection.execute('SELECT value FROM cursors WHERE name = ?', (name,)).fetchone()
+
+        return row[0] if row else None
+
+    def record_cursor(self, name, value):
+        self.pending_cursors.append((name, value, time.time()))
+
+    def commit(self):
+        """Writes recorded rows in a single short transaction, the store may be shared by several threads"""
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO prices (product_id, net_price, offer_id, updated_at) '
+                                        'VALUES (?, ?, ?, ?)', self.pending_prices)
+            self.connection.executemany('INSERT OR REPLACE INTO offers '
+                                        '(offer_id, marker, ean, external_id, fetched_at) '
+                                        'VALUES (?, ?, ?, ?, ?)', self.pending_offers)
+            self.connection.executemany('INSERT OR REPLACE INTO cursors (name, value, updated_at) VALUES (?, ?, ?)',
+                                        self.pending_cursors)
+
+        self.pending_prices = []
+        self.pending_offers = []
+        self.pending_cursors = []
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,451 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from requests.structures import CaseInsensitiveDict
+import asyncio
+import random
+import threading
+import time
+import logging
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from Allegro2Prestashop import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# Not Implemented and HTTP Version Not Supported, e.g. PATCH rejected by older shops
+NOT_IMPLEMENTED = (501, 505)
+
+
+def status_class(status):
+    """Returns retried error class of the status or None, a retry won't help with what the server doesn't implement"""
+    if status == 429:
+        return '429'
+
+    if status >= 500 and status not in NOT_IMPLEMENTED:
+        return '5xx'
+
+    return None
+
+
+def parse_retry_after(value):
+    """Returns number of seconds from Retry-After header (delay-seconds or HTTP-date)"""
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def received_bytes(headers, body):
+    """Returns size of the response as transferred - its Content-Length, the decoded body size if it's missing"""
+    try:
+        return int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return len(body)
+
+
+class TokenBucket(object):
+    """Per-host rate limiter which lowers its rate on throttling and slowly raises it back (AIMD)
+
+    Rate of 0 leaves requests unbounded until the host throttles them, the limit then starts from half of the
+    rate observed so far and is raised back without a cap.
+    """
+
+    def __init__(self, rate, min_rate=1.0):
+        self.max_rate = float(rate) or None
+        self.min_rate = min(float(min_rate), self.max_rate or float(min_rate))
+        self.rate = self.max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled_at = 0.0
+        self.lock = threading.Lock()
+
+        # Requests per second sent while unbounded
+        self.window_start = self.updated
+        self.window_count = 0
+        self.observed_rate = 0.0
+
+    def reserve(self):
+        """Takes one token and returns number of seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate is None:
+                if now - self.window_start >= 1.0:
+                    self.observed_rate = self.window_count / (now - self.window_start)
+                    self.window_start = now
+                    self.window_count = 0
+
+                self.window_count += 1
+                return max(0.0, self.blocked_until - now)
+
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            delay = max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+        return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            old_rate = self.rate
+
+            # Requests in flight get throttled together, the rate is lowered once per second at most
+            if now - self.throttled_at >= 1.0:
+                if self.rate is None:
+                    self.rate = max(self.min_rate, max(self.observed_rate, self.window_count) / 2)
+                    self.tokens = 1.0
+                    self.updated = now
+                else:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled_at = now
+
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+        if self.rate != old_rate:
+            logging.warning(f'Throttled, lowering request rate to {self.rate:.2f}/s')
+
+    def recover(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(self.max_rate or float('inf'), self.rate + 1.0 / max(self.rate, 1.0))
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded per status class and by a per-run budget"""
+
+    def __init__(self, limits, backoff_base=0.5, backoff_max=30.0, budget=1000):
+        self.limits = limits
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        limits = {
+            '429': int(config.get('retry', 'max_429', fallback='5')),
+            '5xx': int(config.get('retry', 'max_5xx', fallback='3')),
+            'connection': int(config.get('retry', 'max_connection', fallback='3')),
+            'timeout': int(config.get('retry', 'max_timeout', fallback='2')),
+        }
+
+        return cls(limits,
+                   backoff_base=float(config.get('retry', 'backoff_base', fallback='0.5')),
+                   backoff_max=float(config.get('retry', 'backoff_max', fallback='30')),
+                   budget=int(config.get('retry', 'budget', fallback='1000')))
+
+    def reset(self):
+        """Starts a new run with the whole budget, e.g. each full reconciliation of the daemon"""
+        with self.lock:
+            self.retries = 0
+
+    def next_delay(self, kind, attempt, retry_after=None):
+        """Returns seconds to wait before the next attempt or None if the request shouldn't be retried"""
+        if attempt >= self.limits.get(kind, 0):
+            return None
+
+        with self.lock:
+            if self.retries >= self.budget:
+                if self.retries == self.budget:
+                    logging.error('Retry budget exhausted, no more requests will be retried in this run')
+                    self.retries += 1
+                return None
+
+            self.retries += 1
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        return delay
+
+
+def session_options(config, name, pool_size):
+    """Returns keyword arguments of Transport read from the config file"""
+    return {
+        'rate': float(config.get('rate_limit', name, fallback='0') or '0'),
+        'min_rate': float(config.get('rate_limit', 'min_rate', fallback='1')),
+        'retry_policy': RetryPolicy.from_config(config),
+        'pool_size': pool_size,
+        'timeout': (float(config.get('transport', 'connect_timeout', fallback='10')),
+                    float(config.get('transport', 'read_timeout', fallback='60'))),
+        'compression': config.getboolean('transport', 'compression', fallback=True),
+        'http2': config.getboolean('transport', 'http2', fallback=False),
+    }
+
+
+class Http2Session(object):
+    """Minimal requests.Session stand-in sending requests over HTTP/2 with httpx"""
+
+    def __init__(self, pool_size):
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                   max_keepalive_connections=pool_size))
+        self.headers = CaseInsensitiveDict(requests.utils.default_headers())
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        connect_timeout, read_timeout = timeout
+
+        try:
+            response = self.client.request(method, url, headers=request_headers, content=data,
+                                           timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+        except httpx.TimeoutException as error:
+            raise Timeout(error)
+
+        except httpx.TransportError as error:
+            raise ConnectionError(error)
+
+        result = requests.Response()
+        result.status_code = response.status_code
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.reason = response.reason_phrase
+        result.url = str(response.url)
+        result.encoding = response.encoding
+        result._content = response.content
+
+        return result
+
+    def close(self):
+        self.client.close()
+
+
+def create_session(pool_size, http2=False, hosts=10):
+    """Returns keep-alive session with pool_size connections per host, it may be shared by several Transports"""
+    if http2 and httpx is None:
+        logging.error('Error: HTTP/2 requires httpx package with http2 extra. Using HTTP/1.1 instead.')
+        http2 = False
+
+    if http2:
+        return Http2Session(pool_size)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+class Transport(object):
+    """Keep-alive HTTP session with rate limiting and retries shared by all API calls
+
+    The session (and its connection pools) can be shared with other Transports, the headers, rate limits
+    and retry budget are always their own.
+    """
+
+    def __init__(self, rate, retry_policy, min_rate=1.0, pool_size=10, timeout=(10.0, 60.0), compression=True,
+                 http2=False, session=None):
+        self.shared = session is not None
+        self.session = session if self.shared else create_session(pool_size, http2, hosts=pool_size)
+
+        self.headers = CaseInsensitiveDict({'Accept-Encoding': 'gzip, deflate' if compression else 'identity'})
+        self.timeout = timeout
+        self.rate = rate
+        self.min_rate = min_rate
+        self.retry_policy = retry_policy
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, name, pool_size=10, session=None):
+        return cls(session=session, **session_options(config, name, pool_size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.min_rate)
+
+            return self.buckets[host]
+
+    def request(self, method, url, **kwargs):
+        bucket = self.bucket(url)
+        endpoint = metrics.endpoint_name(method, url)
+        sent = len(kwargs.get('data') or b'')
+        attempts = {}
+
+        headers = CaseInsensitiveDict(self.headers)
+        headers.update(kwargs.pop('headers', None) or {})
+
+        while True:
+            bucket.acquire()
+            started = time.perf_counter()
+
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+
+            except (ConnectionError, Timeout) as error:
+                kind = 'timeout' if isinstance(error, Timeout) else 'connection'
+                metrics.REGISTRY.observe_request(endpoint, kind, time.perf_counter() - started, sent)
+                if kind == 'timeout':
+                    bucket.throttle()
+                delay = self.retry_policy.next_delay(kind, attempts.get(kind, 0))
+                if delay is None:
+                    raise
+
+                logging.warning(f'Retrying {method} {url} in {delay:.1f}s due to {kind} error: {error}')
+
+            else:
+                metrics.REGISTRY.observe_request(endpoint, response.status_code, time.perf_counter() - started, sent,
+                                                 received_bytes(response.headers, response.content))
+                kind = status_class(response.status_code)
+                if kind is None:
+                    bucket.recover()
+                    return response
+
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                bucket.throttle(retry_after)
+
+                delay = self.retry_policy.next_delay(kind, attempts.get(kind, 0), retry_after)
+                if delay is None:
+                    return response
+
+                logging.warning(f'Retrying {method} {url} in {delay:.1f}s due to HTTP {response.status_code}')
+
+            metrics.REGISTRY.count_retry(endpoint, kind)
+            attempts[kind] = attempts.get(kind, 0) + 1
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self):
+        # A shared session is closed by its owner
+        if not self.shared:
+            self.session.close()
+
+
+class AsyncTransport(Transport):
+    """aiohttp counterpart of Transport, responses are returned with the body already read"""
+
+    def __init__(self, rate, retry_policy, min_rate=1.0, pool_size=10, timeout=(10.0, 60.0), compression=True,
+                 http2=False, headers=None):
+        if http2:
+            logging.warning('HTTP/2 is not supported by the async engine. Using HTTP/1.1 instead.')
+
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip, deflate' if compression else 'identity'
+
+        self.rate = rate
+        self.min_rate = min_rate
+        self.retry_policy = retry_policy
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.session = aiohttp.ClientSession(headers=headers,
+                                             connector=aiohttp.TCPConnector(limit=pool_size),
+                                             timeout=aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                                                           sock_read=timeout[1]))
+
+    @classmethod
+    def from_config(cls, config, name, pool_size=10, headers=None):
+        return cls(headers=headers, **session_options(config, name, pool_size))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def request(self, method, url, **kwargs):
+        bucket = self.bucket(url)
+        endpoint = metrics.endpoint_name(method, url)
+        sent = len(kwargs.get('data') or b'')
+        attempts = {}
+
+        while True:
+            await bucket.acquire_async()
+            started = time.perf_counter()
+
+            try:
+                response = await self.session.request(method, url, **kwargs)
+                body = await response.read()
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                kind = 'timeout' if isinstance(error, asyncio.TimeoutError) else 'connection'
+                metrics.REGISTRY.observe_request(endpoint, kind, time.perf_counter() - started, sent)
+                if kind == 'timeout':
+                    bucket.throttle()
+                delay = self.retry_policy.next_delay(kind, attempts.get(kind, 0))
+                if delay is None:
+                    raise
+
+                logging.warning(f'Retrying {method} {url} in {delay:.1f}s due to {kind} error: {error!r}')
+
+            else:
+                metrics.REGISTRY.observe_request(endpoint, response.status, time.perf_counter() - started, sent,
+                                                 received_bytes(response.headers, body))
+                kind = status_class(response.status)
+                if kind is None:
+                    bucket.recover()
+                    return response
+
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                bucket.throttle(retry_after)
+
+                delay = self.retry_policy.next_delay(kind, attempts.get(kind, 0), retry_after)
+                if delay is None:
+                    return response
+
+                logging.warning(f'Retrying {method} {url} in {delay:.1f}s due to HTTP {response.status}')
+
+            metrics.REGISTRY.count_retry(endpoint, kind)
+            attempts[kind] = attempts.get(kind, 0) + 1
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('PATCH', url, **kwargs)
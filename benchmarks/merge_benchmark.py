@@ -0,0 +1,50 @@
+"""Micro-benchmark of the EAN matching engine
+
+Usage: python -m benchmarks.merge_benchmark [sizes...]
+"""
+import random
+import sys
+import time
+
+from Allegro2Prestashop import matching
+from Allegro2Prestashop.records import Offer, PSProduct
+
+
+def make_catalog(size, seed=0):
+    rng = random.Random(seed)
+    eans = [str(rng.randrange(10 ** 12, 10 ** 13)) for _ in range(size)]
+
+    ids = []
+    for number, ean in enumerate(eans):
+        ids.append(PSProduct(None if rng.random() < 0.02 else ean, str(number)))
+
+    offered = rng.sample(eans, int(size * 0.9))
+    offered.extend(str(rng.randrange(10 ** 12, 10 ** 13)) for _ in range(size - len(offered)))
+
+    prices = []
+    for number, ean in enumerate(offered):
+        prices.append(Offer(None if rng.random() < 0.02 else ean, str(rng.randrange(100, 100000) / 100),
+                            'offer' + str(number)))
+
+    return ids, prices
+
+
+def run(size):
+    ids, prices = make_catalog(size)
+
+    start = time.perf_counter()
+    merged = matching.merge(ids, prices)
+    elapsed = time.perf_counter() - start
+
+    print(f'{size:>8} products  {len(merged):>8} results  {elapsed * 1000:10.1f} ms  '
+          f'{elapsed / size * 1e6:6.2f} us/product')
+
+
+def main(argv):
+    sizes = [int(size) for size in argv] or [1000, 10000, 100000]
+    for size in sizes:
+        run(size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
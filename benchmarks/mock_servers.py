@@ -0,0 +1,312 @@
+"""Local stand-ins for the Allegro and Prestashop APIs used by the benchmarks
+
+One HTTP server emulates both services:
+
+* /allegro/sale/offers, /allegro/sale/offers/{id} - Allegro offers listing and details
+* /allegro/sale/offer-events - Allegro offer events feed, filled by Catalog.change_price()
+* /auth/oauth/device, /auth/oauth/token - Allegro OAuth endpoints
+* /api/products?display=[id,ean13], GET /api/products/{id}, PUT /api/products, PATCH /api/products/{id} -
+  Prestashop webservice, PATCH answers 405 like shops before 1.7.8 when started with --no-patch
+* /_stats, /_reset - request counts and server-side latency percentiles
+
+Usage: python -m benchmarks.mock_servers --size 10000 --latency 0.01 --error-rate 0.01 --throttle-rate 0.01
+"""
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.etree import ElementTree
+
+
+PRODUCT_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n<prestashop xmlns:xlink="http://www.w3.org/1999/xlink">'
+               '<product><id>{id}</id><manufacturer_name>Mock</manufacturer_name><quantity>5</quantity>'
+               '<ean13>{ean}</ean13><price>{price}</price><name><language id="1">Product {id}</language></name>'
+               '<description><language id="1">{description}</language></description></product></prestashop>')
+
+
+def ean(number):
+    return str(5900000000000 + number)
+
+
+def price(number):
+    return '%.2f' % (10 + number % 990 + (number % 100) / 100)
+
+
+class Catalog(object):
+    """Deterministic catalog shared by both APIs, a part of the offers has no EAN or no Prestashop product"""
+
+    def __init__(self, size, ps_overlap=0.95):
+        self.size = size
+        self.ps_size = int(size * ps_overlap)
+        self.prices = {}
+        self.offer_prices = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def offer(self, number):
+        return {
+            'id': str(number),
+            'name': 'Offer ' + str(number),
+            'sellingMode': {'format': 'BUY_NOW', 'price': {'amount': self.offer_prices.get(number, price(number)),
+                                                           'currency': 'PLN'}},
+            'stock': {'available': number % 7, 'sold': 0},
+            'publication': {'status': 'ACTIVE'},
+            'external': {'id': '*'} if number % 97 == 0 else None,
+        }
+
+    def change_price(self, number, amount):
+        """Changes price of the Allegro offer and publishes OFFER_PRICE_CHANGED event"""
+        with self.lock:
+            self.offer_prices[number] = amount
+            self.events.append({'id': str(len(self.events) + 1), 'type': 'OFFER_PRICE_CHANGED',
+                                'occurredAt': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                                'offer': {'id': str(number)}})
+
+    def offer_detail(self, number):
+        detail = self.offer(number)
+        detail['parameters'] = [{'id': '11323', 'values': ['Nowy']}]
+        if number % 50 != 0:
+            detail['parameters'].append({'id': '225693', 'values': [ean(number)]})
+
+        return detail
+
+    def create_database(self, db_path):
+        """Creates SQLite stand-in of ps_product and ps_product_shop tables for the database sink"""
+        connection = sqlite3.connect(db_path)
+        connection.execute('CREATE TABLE ps_product (id_product INTEGER PRIMARY KEY, ean13 TEXT, '
+                           'price DECIMAL(20, 6) NOT NULL DEFAULT 0, date_upd DATETIME)')
+        connection.execute('CREATE TABLE ps_product_shop (id_product INTEGER, id_shop INTEGER, '
+                           'price DECIMAL(20, 6) NOT NULL DEFAULT 0, date_upd DATETIME, '
+                           'PRIMARY KEY (id_product, id_shop))')
+        connection.executemany('INSERT INTO ps_product (id_product, ean13) VALUES (?, ?)',
+                               ((number + 1, ean(number)) for number in range(self.ps_size)))
+        connection.executemany('INSERT INTO ps_product_shop (id_product, id_shop) VALUES (?, 1)',
+                               ((number + 1,) for number in range(self.ps_size)))
+        connection.commit()
+        connection.close()
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.statuses = {}
+
+    def record(self, endpoint, status, latency):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                endpoints[endpoint] = {
+                    'count': len(latencies),
+                    'p50': latencies[len(latencies) // 2],
+                    'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                }
+
+            return {'endpoints': endpoints, 'statuses': {str(key): value for key, value in self.statuses.items()}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+        return status
+
+    def _json(self, data, status=200):
+        return self._send(status, json.dumps(data).encode('utf-8'))
+
+    def _handle(self, method):
+        started = time.perf_counter()
+        server = self.server
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        endpoint = method + ' ' + '/'.join(part if not part.isdigit() else '{id}' for part in parts)
+
+        if not parts:
+            return self._json({'error': 'not found'}, status=404)
+
+        if parts[0] == '_stats':
+            return self._json(server.stats.summary())
+
+        if parts[0] == '_reset':
+            server.stats.reset()
+            return self._json({})
+
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        if parts[0] == 'allegro' and self.headers.get('Authorization', '').partition(' ')[2] in server.revoked:
+            status = self._send(401)
+        elif parts[0] in ('allegro', 'api') and random.random() < server.throttle_rate:
+            status = self._send(429, headers={'Retry-After': '1'})
+        elif parts[0] in ('allegro', 'api') and random.random() < server.error_rate:
+            status = self._send(random.choice((500, 502, 503)))
+        else:
+            status = self._route(method, parts, parse_qs(url.query), body)
+
+        server.stats.record(endpoint, status, time.perf_counter() - started)
+
+    def _route(self, method, parts, query, body):
+        catalog = self.server.catalog
+
+        if parts[:2] == ['auth', 'oauth']:
+            return self._json({'access_token': 'mock-access', 'refresh_token': 'mock-refresh', 'expires_in': 43199,
+                               'token_type': 'bearer'})
+
+        if parts[:3] == ['allegro', 'sale', 'offer-events']:
+            limit = int(query.get('limit', ['100'])[0])
+            start = int(query.get('from', ['0'])[0])
+            with catalog.lock:
+                events = catalog.events[start:start + limit]
+
+            return self._json({'offerEvents': events})
+
+        if parts[:3] == ['allegro', 'sale', 'offers'] and len(parts) == 3:
+            limit = int(query.get('limit', ['20'])[0])
+            offset = int(query.get('offset', ['0'])[0])
+            numbers = range(offset, min(offset + limit, catalog.size))
+
+            return self._json({'offers': [catalog.offer(number) for number in numbers],
+                               'count': len(numbers), 'totalCount': catalog.size})
+
+        if parts[:3] == ['allegro', 'sale', 'offers'] and len(parts) == 4:
+            return self._json(catalog.offer_detail(int(parts[3])))
+
+        if parts[:2] == ['api', 'products'] and method == 'GET' and len(parts) == 2:
+            numbers = range(catalog.ps_size)
+            limit = query.get('limit', [''])[0]
+            if limit:
+                offset, _, count = limit.rpartition(',')
+                numbers = numbers[int(offset or 0):int(offset or 0) + int(count)]
+
+            with catalog.lock:
+                products = [{'id': number + 1, 'ean13': ean(number) if number % 40 else '',
+                             'price': catalog.prices.get(number, '0.000000')}
+                            for number in numbers]
+
+            # Only the fields listed in display=[...] are returned
+            display = query.get('display', [''])[0].strip('[]').split(',')
+            products = [{name: value for name, value in product.items() if name in display} for product in products]
+
+            # Like Prestashop, an empty list instead of an object past the last product
+            return self._json({'products': products} if products else [])
+
+        if parts[:2] == ['api', 'products'] and method == 'GET':
+            number = int(parts[2]) - 1
+            with catalog.lock:
+                current = catalog.prices.get(number, '0.000000')
+            xml = PRODUCT_XML.format(id=number + 1, ean=ean(number), price=current, description='x' * 2000)
+
+            return self._send(200, xml.encode('utf-8'), content_type='text/xml')
+
+        if parts[:2] == ['api', 'products'] and method == 'PATCH' and not self.server.patch:
+            return self._json({'errors': [{'code': 3, 'message': 'Method PATCH is not valid'}]},
+                              status=self.server.patch_status)
+
+        if parts[:2] == ['api', 'products'] and method in ('PUT', 'PATCH'):
+            tree = ElementTree.fromstring(body)
+            product_id = tree.find('./product/id').text
+            new_price = tree.find('./product/price').text
+            new_price = '%.6f' % float(new_price)
+            with catalog.lock:
+                catalog.prices[int(product_id) - 1] = new_price
+
+            return self._json({'product': {'id': int(product_id), 'price': new_price}})
+
+        return self._json({'error': 'not found'}, status=404)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, size=1000, latency=0.0, error_rate=0.0, throttle_rate=0.0, patch=True):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.catalog = Catalog(size)
+        self.stats = Stats()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.patch = patch
+        # Status of the rejected PATCH requests
+        self.patch_status = 405
+        # Allegro access tokens answered with 401
+        self.revoked = set()
+
+    def handle_error(self, request, client_address):
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + '/'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='MockServer', daemon=True)
+        thread.start()
+
+        return self
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Mock Allegro and Prestashop APIs')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', type=int, default=1000, help='number of Allegro offers')
+    parser.add_argument('--latency', type=float, default=0.0, help='average response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 5xx responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--no-patch', action='store_true', help='reject PATCH like Prestashop before 1.7.8')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = MockServer(args.port, args.size, args.latency, args.error_rate, args.throttle_rate, not args.no_patch)
+    print('Serving mock APIs on ' + server.url, flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
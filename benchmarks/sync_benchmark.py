@@ -0,0 +1,169 @@
+"""End-to-end sync benchmark against the local mock APIs
+
+Every scenario runs Allegro2Prestashop.main() in a fresh process and working directory, so peak RSS is
+the one of the sync alone and no state is carried over between scenarios (unless --repeat is used).
+Request latencies are measured by the mock server.
+
+Usage: python -m benchmarks.sync_benchmark --sizes 1000 10000 100000 --engines threaded async --stream
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_servers import Catalog, MockServer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """[allegro]
+client_id = mock
+client_secret = mock
+api_url = {url}allegro/
+auth_url = {url}auth/oauth/
+
+[mail_auth]
+receiver = mock@localhost
+subject = Mock
+content = Mock
+user =
+passwd =
+server =
+port = 0
+delivery_attempts = 1
+
+[api]
+url = {url}api/
+key = MOCK
+
+[mail]
+receiver = mock@localhost
+subject = Mock
+content_lang = en
+user =
+passwd =
+server =
+port = 0
+delivery_attempts = 1
+
+[state]
+path = conf/state.db
+
+[engine]
+mode = {engine}
+allegro_concurrency = {concurrency}
+prestashop_concurrency = {concurrency}
+sink = {sink}
+
+[database]
+driver = sqlite
+path = conf/prestashop.db
+batch_size = 500
+
+[retry]
+backoff_base = 0.05
+budget = 1000000
+
+[log]
+log_level = {log_level}
+"""
+
+
+def prepare(directory, server, args, engine, sink):
+    os.makedirs(os.path.join(directory, 'conf'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'logs'), exist_ok=True)
+
+    with open(os.path.join(directory, 'conf', 'config.ini'), 'w') as outfile:
+        outfile.write(CONFIG.format(url=server.url, engine=engine, sink=sink, concurrency=args.concurrency,
+                                    log_level=args.log_level))
+
+    if sink == 'database':
+        server.catalog.create_database(os.path.join(directory, 'conf', 'prestashop.db'))
+
+    with open(os.path.join(directory, 'conf', 'token.json'), 'w') as outfile:
+        json.dump({'access_token': 'mock-access', 'refresh_token': 'mock-refresh'}, outfile)
+
+
+def run_client(argv):
+    """Runs a single sync in the current working directory and prints its measurements as JSON"""
+    import Allegro2Prestashop
+
+    started = time.perf_counter()
+    Allegro2Prestashop.main(argv)
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({'elapsed': elapsed, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def run_scenario(server, directory, size, label, stream):
+    server.stats.reset()
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    argv = ['--stream'] if stream else []
+
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.sync_benchmark', '--client', '--'] + argv,
+                            cwd=directory, env=env, stdout=subprocess.PIPE, check=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    stats = server.stats.summary()
+
+    requests = sum(endpoint['count'] for endpoint in stats['endpoints'].values())
+    print(f'{size:>8} {label + (" stream" if stream else ""):<25} {result["elapsed"]:9.2f} s '
+          f'{size / result["elapsed"]:10.1f} offers/s {requests:>8} requests '
+          f'{result["peak_rss_mb"]:8.1f} MB peak RSS', flush=True)
+
+    for name, endpoint in sorted(stats['endpoints'].items()):
+        print(f'{"":>10}{name:<34} {endpoint["count"]:>8}  p50 {endpoint["p50"] * 1000:8.2f} ms  '
+              f'p99 {endpoint["p99"] * 1000:8.2f} ms')
+
+    errors = {status: count for status, count in stats['statuses'].items() if status != '200'}
+    if errors:
+        print(f'{"":>10}non-200 responses: {errors}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Allegro2Prestashop against mock APIs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--engines', nargs='+', default=['threaded'], choices=['threaded', 'async'])
+    parser.add_argument('--sinks', nargs='+', default=['webservice'], choices=['webservice', 'database'],
+                        help='price sinks, database writes to a SQLite stand-in of the Prestashop tables')
+    parser.add_argument('--stream', action='store_true', help='also run every engine in --stream mode')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario sharing the state store')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='average mock response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 5xx responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--no-patch', action='store_true', help='mock shop rejects PATCH, updates use GET + PUT')
+    parser.add_argument('--log-level', type=int, default=20)
+    parser.add_argument('--client', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('client_args', nargs='*', help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.client:
+        return run_client(args.client_args)
+
+    for size in args.sizes:
+        server = MockServer(0, size, args.latency, args.error_rate, args.throttle_rate, not args.no_patch).start()
+
+        for engine in args.engines:
+            for sink in args.sinks:
+                for stream in ([False, True] if args.stream else [False]):
+                    # Every scenario starts with a shop which has none of the prices yet
+                    server.catalog = Catalog(size)
+                    with tempfile.TemporaryDirectory() as directory:
+                        prepare(directory, server, args, engine, sink)
+                        for _ in range(args.repeat):
+                            run_scenario(server, directory, size, engine + ' ' + sink, stream)
+
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
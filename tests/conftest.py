@@ -0,0 +1,34 @@
+import configparser
+import json
+
+import pytest
+
+from benchmarks.mock_servers import MockServer
+from benchmarks.sync_benchmark import CONFIG
+
+
+@pytest.fixture
+def mock_server():
+    server = MockServer(0, 100).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch, mock_server):
+    """Returns factory of configs pointing at the mock server, with every file kept in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'conf').mkdir()
+    (tmp_path / 'logs').mkdir()
+    with open(tmp_path / 'conf' / 'token.json', 'w') as outfile:
+        json.dump({'access_token': 'mock-access', 'refresh_token': 'mock-refresh'}, outfile)
+
+    def make(engine='threaded', sink='webservice', **sections):
+        config = configparser.ConfigParser()
+        config.read_string(CONFIG.format(url=mock_server.url, engine=engine, sink=sink, concurrency=4, log_level=20))
+        config.read_dict(sections)
+
+        return config
+
+    return make
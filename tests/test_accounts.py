@@ -0,0 +1,48 @@
+import configparser
+
+from Allegro2Prestashop import accounts
+
+
+def make_config():
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'accounts': {'names': 'main, outlet,'},
+        'allegro': {'client_id': 'main-id', 'client_secret': 'secret'},
+        'allegro:outlet': {'client_id': 'outlet-id'},
+        'api': {'url': 'https://shop.example/api/'},
+        'engine:outlet': {'allegro_concurrency': '4'},
+        'mail': {'receiver': 'shop@example.com', 'report_path': 'logs/report.csv.gz'},
+        'state:main': {'path': 'conf/main.db'},
+    })
+
+    return config
+
+
+def test_account_names():
+    assert accounts.account_names(make_config()) == ['main', 'outlet']
+    assert accounts.account_names(configparser.ConfigParser()) == []
+
+
+def test_account_config_overrides_and_defaults():
+    config = make_config()
+    outlet = accounts.account_config(config, 'outlet')
+
+    assert outlet['allegro']['client_id'] == 'outlet-id'
+    assert outlet['allegro']['client_secret'] == 'secret'
+    assert outlet['engine']['allegro_concurrency'] == '4'
+    assert outlet['api']['url'] == 'https://shop.example/api/'
+    assert outlet['mail']['receiver'] == 'shop@example.com'
+
+    assert outlet['allegro']['token_path'] == 'conf/token-outlet.json'
+    assert outlet['state']['path'] == 'conf/state-outlet.db'
+    assert outlet['journal']['path'] == 'logs/journal-outlet.jsonl'
+    assert outlet['mail']['report_path'] == 'logs/report-outlet.csv.gz'
+
+    main = accounts.account_config(config, 'main')
+    assert main['allegro']['client_id'] == 'main-id'
+    assert main['state']['path'] == 'conf/main.db'
+    assert not main.has_option('engine', 'allegro_concurrency')
+
+    # The base config is left untouched
+    assert config['allegro']['client_id'] == 'main-id'
+    assert not config.has_option('allegro', 'token_path')
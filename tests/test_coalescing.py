@@ -0,0 +1,87 @@
+import configparser
+import csv
+import gzip
+from types import SimpleNamespace
+
+from Allegro2Prestashop import core, matching
+from Allegro2Prestashop.records import MergeResult, Offer, PSProduct
+from benchmarks.mock_servers import ean
+
+
+EAN = '5901234123457'
+
+
+def product(product_id, price, offer_id, active=None):
+    return MergeResult(ean=EAN, product_id=product_id, price=price, offer_id=offer_id, active=active)
+
+
+def test_merge_gives_every_product_sharing_an_ean_all_offers():
+    ids = [PSProduct(EAN, '1'), PSProduct(EAN, '2')]
+    merged = matching.merge(ids, [Offer(EAN, 30, 'A'), Offer(EAN, 20, 'B')])
+
+    assert [(result.product_id, result.offer_id) for result in merged] == [('1', 'A'), ('2', 'A'),
+                                                                            ('1', 'B'), ('2', 'B')]
+
+    chosen, conflicts, saved = matching.Coalescer().coalesce(merged)
+    assert [(result.product_id, result.offer_id) for result in chosen] == [('1', 'B'), ('2', 'B')]
+    assert [str(conflict) for conflict in conflicts] == ['1: B (20), A (30)', '2: B (20), A (30)']
+    assert saved == 2
+
+
+def test_coalesce_lowest():
+    chosen, conflicts, saved = matching.Coalescer().coalesce([product('1', '30', 'A'), product('2', '5', 'C'),
+                                                              product('1', '20.0', 'B')])
+
+    assert [(result.product_id, result.offer_id) for result in chosen] == [('1', 'B'), ('2', 'C')]
+    assert len(conflicts) == 1
+    assert conflicts[0].chosen.offer_id == 'B'
+    assert [result.offer_id for result in conflicts[0].rejected] == ['A']
+    assert saved == 1
+
+
+def test_coalesce_same_prices_are_no_conflict_and_ties_break_by_offer_id():
+    for order in (('B', 'A'), ('A', 'B')):
+        chosen, conflicts, saved = matching.Coalescer().coalesce([product('1', '20', offer) for offer in order])
+
+        assert [result.offer_id for result in chosen] == ['A']
+        assert conflicts == []
+        assert saved == 1
+
+
+def test_coalesce_active_rule_and_pinned_offers():
+    products = [product('1', '10', 'A', active=False), product('1', '20', 'B', active=True),
+                product('1', '15', 'C')]
+
+    assert matching.Coalescer('lowest').choose(products).offer_id == 'A'
+    assert matching.Coalescer('active').choose(products).offer_id == 'C'
+    assert matching.Coalescer('active', {'1': 'B'}).choose(products).offer_id == 'B'
+    assert matching.Coalescer('lowest', {'2': 'B'}).choose(products).offer_id == 'A'
+
+
+def test_coalescer_from_config():
+    config = configparser.ConfigParser()
+    config.read_dict({'coalesce': {'rule': 'active', 'pinned': '1 = A, 2=B,, 3='}})
+
+    coalescer = matching.Coalescer.from_config(config)
+    assert coalescer.rule == 'active'
+    assert coalescer.pinned == {'1': 'A', '2': 'B'}
+
+    config['coalesce']['rule'] = 'newest'
+    assert matching.Coalescer.from_config(config).rule == 'lowest'
+
+
+def test_stream_reports_the_chosen_price_once(make_config, mock_server):
+    # Products 2-4 with one offer each, product 3 gets the lower price of its second offer after the first one
+    offers = [Offer(ean(number), '24.60', str(number)) for number in (1, 2, 3)] + [Offer(ean(2), '12.30', 'low')]
+    fetcher = SimpleNamespace(iter_prices=lambda queue_size: iter(offers), skipped=0)
+    wrapper = core.PSApiWrapper(config=make_config())
+
+    report = wrapper.update_stream(fetcher, send_report=False)
+
+    assert (report.values['updated'], report.values['failed'], report.values['conflicts']) == (3, 0, 1)
+    assert mock_server.catalog.prices[2] == '10.000000'
+    with gzip.open(report.file_path, 'rt', encoding='utf-8') as infile:
+        rows = [row for row in csv.DictReader(infile) if row['status'] == 'updated']
+    assert sorted((row['product_id'], row['price']) for row in rows) == [('2', '24.60'), ('3', '12.30'),
+                                                                         ('4', '24.60')]
+    wrapper.close()
@@ -0,0 +1,22 @@
+import configparser
+from types import SimpleNamespace
+
+from Allegro2Prestashop.daemon import Daemon
+from Allegro2Prestashop.transport import RetryPolicy
+
+
+def test_reconciliation_resets_the_retry_budget():
+    fetcher = SimpleNamespace(transport=SimpleNamespace(retry_policy=RetryPolicy({'5xx': 3}, budget=2)),
+                              get_prices=lambda: ([], 0))
+    wrapper = SimpleNamespace(transport=SimpleNamespace(retry_policy=RetryPolicy({'5xx': 3}, budget=2)))
+    service = Daemon(fetcher, wrapper, configparser.ConfigParser())
+
+    for policy in (fetcher.transport.retry_policy, wrapper.transport.retry_policy):
+        while policy.next_delay('5xx', 0) is not None:
+            pass
+
+    service._reconcile(store=None)
+    service.executor.shutdown(wait=True)
+
+    assert fetcher.transport.retry_policy.next_delay('5xx', 0) is not None
+    assert wrapper.transport.retry_policy.next_delay('5xx', 0) is not None
@@ -0,0 +1,93 @@
+import json
+
+from Allegro2Prestashop.journal import RunJournal
+from Allegro2Prestashop.records import MergeResult
+
+
+def write_interrupted(file_path, run='sync'):
+    journal = RunJournal(file_path, run)
+    journal.page(0, 2000)
+    journal.offer('1', ['590', None], '12.30', 'ACTIVE')
+    journal.offer('2', None, None)
+    journal.update(MergeResult(product_id='7', offer_id='1'), True)
+    journal.update(MergeResult(product_id='8', offer_id='2'), False)
+    journal.close()
+
+
+def test_resume_loads_completed_work(tmp_path):
+    file_path = str(tmp_path / 'journal.jsonl')
+    write_interrupted(file_path)
+
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert journal.pages == {0: 2000}
+    assert journal.offers == {'1': (['590', None], '12.30', 'ACTIVE'), '2': (None, None, None)}
+    assert journal.updates == {('7', '1')}
+    assert journal.is_applied(MergeResult(product_id='7', offer_id='1'))
+    assert not journal.is_applied(MergeResult(product_id='7', offer_id='2'))
+    journal.close()
+
+
+def test_resume_stops_at_partially_written_line(tmp_path):
+    file_path = str(tmp_path / 'journal.jsonl')
+    write_interrupted(file_path)
+    with open(file_path, 'a') as outfile:
+        outfile.write(json.dumps({'t': 'page', 'offset': 1000, 'total': 2000})[:-5])
+
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert journal.pages == {0: 2000}
+    assert len(journal.offers) == 2
+    journal.page(1000, 2000)
+    journal.close()
+
+    # The partial line was dropped, so the records of the resumed run can be read back
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert journal.pages == {0: 2000, 1000: 2000}
+    assert len(journal.offers) == 2
+    assert journal.updates == {('7', '1')}
+    journal.close()
+
+
+def test_resume_appends_to_the_journal(tmp_path):
+    file_path = str(tmp_path / 'journal.jsonl')
+    write_interrupted(file_path)
+
+    journal = RunJournal(file_path, 'sync', resume=True)
+    journal.page(1000, 2000)
+    journal.close()
+
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert journal.pages == {0: 2000, 1000: 2000}
+    journal.close()
+
+
+def test_nothing_to_resume(tmp_path):
+    file_path = str(tmp_path / 'journal.jsonl')
+
+    # Missing file
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert (journal.pages, journal.offers, journal.updates) == ({}, {}, set())
+    journal.close()
+
+    # Different run
+    write_interrupted(file_path, run='sync --full')
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert (journal.pages, journal.offers, journal.updates) == ({}, {}, set())
+    journal.finish()
+
+    # Completed run
+    journal = RunJournal(file_path, 'sync', resume=True)
+    assert (journal.pages, journal.offers, journal.updates) == ({}, {}, set())
+    journal.close()
+
+
+def test_without_resume_the_journal_starts_over(tmp_path):
+    file_path = str(tmp_path / 'journal.jsonl')
+    write_interrupted(file_path)
+
+    RunJournal(file_path, 'sync').close()
+
+    with open(file_path) as infile:
+        records = [json.loads(line) for line in infile]
+
+    assert [record['t'] for record in records] == ['start']
+    assert records[0]['run'] == 'sync'
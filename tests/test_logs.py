@@ -0,0 +1,68 @@
+import atexit
+import configparser
+import json
+import logging
+import threading
+
+import pytest
+
+from Allegro2Prestashop import logs
+
+
+@pytest.fixture
+def json_log(tmp_path, monkeypatch):
+    """Sets up JSON logging into tmp_path, returns function stopping it and returning the entries"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'logs').mkdir()
+    config = configparser.ConfigParser()
+    config.read_dict({'log': {'log_level': '20', 'format': 'json'}})
+
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    listener = logs.setup(config)
+    atexit.unregister(listener.stop)
+
+    def stop():
+        if root.handlers != handlers:
+            listener.stop()
+            root.handlers[:], root.level = handlers, level
+
+    def read():
+        stop()
+        with open(tmp_path / 'logs' / 'app.log', encoding='utf-8') as infile:
+            return [json.loads(line) for line in infile]
+
+    yield read
+    stop()
+
+
+def test_tracebacks_are_formatted_by_the_listener(json_log, monkeypatch):
+    formatted_in = []
+    format_exception = logs.JsonFormatter.formatException
+
+    def record_thread(self, exc_info):
+        formatted_in.append(threading.current_thread())
+        return format_exception(self, exc_info)
+
+    monkeypatch.setattr(logs.JsonFormatter, 'formatException', record_thread)
+
+    try:
+        raise ValueError('broken offer')
+    except ValueError as error:
+        logging.exception('Error occurred while getting the price: %s', error)
+
+    entries = json_log()
+
+    assert [entry['message'] for entry in entries] == ['Error occurred while getting the price: broken offer']
+    assert entries[0]['level'] == 'ERROR'
+    assert entries[0]['exception'].startswith('Traceback')
+    assert entries[0]['exception'].endswith('ValueError: broken offer')
+    assert formatted_in and threading.current_thread() not in formatted_in
+
+
+def test_messages_are_rendered_when_logged(json_log):
+    offer = {'id': '1'}
+    logging.info('Offer %s', offer)
+    offer['id'] = '2'
+
+    assert [entry['message'] for entry in json_log()] == ["Offer {'id': '1'}"]
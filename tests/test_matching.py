@@ -0,0 +1,38 @@
+from Allegro2Prestashop import matching
+from Allegro2Prestashop.records import Offer, PSProduct
+
+
+EAN = '5901234123457'
+
+
+def test_normalize_ean():
+    assert matching.normalize_ean(None) is None
+    assert matching.normalize_ean('  ') is None
+    assert matching.normalize_ean(' 123 ') == '0000000000123'
+    assert matching.normalize_ean(5901234123457) == EAN
+    assert matching.normalize_ean('ABC') == 'ABC'
+
+
+def test_ean_index_matches_every_product_with_the_ean():
+    index = matching.EanIndex([PSProduct(EAN, '1'), PSProduct('0' + EAN[1:], '2'), PSProduct('123', '3'),
+                               PSProduct(EAN, '4'), PSProduct(None, '5')])
+
+    assert len(index) == 5
+    assert [p.product_id for p in index.missing] == ['5']
+    assert [p.product_id for p in index.match(int(EAN))] == ['1', '4']
+    assert [p.product_id for p in index.match(EAN)] == ['1', '4']
+    assert index.match('999') == []
+    assert [p.product_id for p in index.unmatched()] == ['2', '3']
+
+
+def test_merge_labels():
+    ids = [PSProduct(EAN, '1', '10.000000'), PSProduct(None, '2'), PSProduct('123', '3')]
+    prices = [Offer(EAN, 12.3, 'A'), Offer(None, 5, 'B'), Offer('999', 5, 'C')]
+
+    merged = matching.merge(ids, prices)
+
+    assert [str(result) for result in merged] == [EAN + ' 1', 'EAN - Allegro B', 'EAN - PS 2',
+                                                  'Mismatched PS 3', 'Mismatched Allegro C']
+    assert merged[0].price == '12.3'
+    assert merged[0].current_price == '10.000000'
+    assert [str(result) for result in matching.merge(ids, prices, 'pl')][-1] == 'Niedopasowano Allegro C'
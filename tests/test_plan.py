@@ -0,0 +1,62 @@
+import argparse
+import gzip
+import json
+
+import pytest
+
+from Allegro2Prestashop import plan
+from Allegro2Prestashop.records import Conflict, MergeResult
+
+
+def net_price(price):
+    return str(round(float(price) / 1.23, 2))
+
+
+def test_parse_shard():
+    assert plan.parse_shard('1/4') == (1, 4)
+    assert plan.parse_shard('4/4') == (4, 4)
+
+    for value in ('0/4', '5/4', '1', 'a/b', '1/2/3'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            plan.parse_shard(value)
+
+
+def test_shards_split_products_by_id():
+    product_ids = [str(product_id) for product_id in range(1, 101)]
+    shards = [[product_id for product_id in product_ids if plan.in_shard(product_id, (index, 3))]
+              for index in (1, 2, 3)]
+
+    assert sorted(sum(shards, [])) == sorted(product_ids)
+    assert all(30 <= len(shard) <= 35 for shard in shards)
+    assert all(plan.in_shard(product_id, None) for product_id in product_ids)
+
+
+def test_write_and_read_plan(tmp_path):
+    file_path = str(tmp_path / 'plan.jsonl.gz')
+    changes = [MergeResult(ean='590', product_id=str(product_id), price='12.30', offer_id='o' + str(product_id),
+                           current_price='9.000000') for product_id in range(1, 11)]
+    not_updated = [MergeResult('EAN - PS', product_id='11')]
+    conflicts = [Conflict(changes[0], [MergeResult(product_id='1', price='15', offer_id='x')])]
+
+    plan.write_plan(file_path, changes, not_updated, 3, 4, net_price, conflicts, 1)
+
+    header, products = plan.read_plan(file_path)
+    assert header['changes'] == 10
+    assert (header['skipped'], header['unchanged'], header['saved']) == (3, 4, 1)
+    assert header['not_updated'] == ['EAN - PS 11']
+    assert header['conflicts'] == ['1: o1 (12.30), x (15)']
+    assert [(p.product_id, p.price, p.offer_id, p.current_price) for p in products] == \
+        [(c.product_id, c.price, c.offer_id, c.current_price) for c in changes]
+
+    shards = [plan.read_plan(file_path, (index, 4))[1] for index in (1, 2, 3, 4)]
+    assert sorted(p.product_id for shard in shards for p in shard) == sorted(c.product_id for c in changes)
+    assert [p.product_id for p in shards[1]] == ['1', '5', '9']
+
+
+def test_read_plan_rejects_other_versions(tmp_path):
+    file_path = str(tmp_path / 'plan.jsonl.gz')
+    with gzip.open(file_path, 'wt', encoding='utf-8') as outfile:
+        outfile.write(json.dumps({'version': plan.VERSION + 1, 'changes': 0}) + '\n')
+
+    with pytest.raises(RuntimeError):
+        plan.read_plan(file_path)
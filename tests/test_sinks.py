@@ -0,0 +1,68 @@
+import sqlite3
+
+from Allegro2Prestashop import core, sinks
+from Allegro2Prestashop.records import MergeResult
+
+
+def prices(db_path, table):
+    connection = sqlite3.connect(db_path)
+    rows = dict(connection.execute('SELECT id_product, price FROM ' + table + ' WHERE id_product <= 5'))
+    connection.close()
+
+    return rows
+
+
+def database_wrapper(make_config, mock_server, **options):
+    mock_server.catalog.create_database('conf/prestashop.db')
+    options = dict({'driver': 'sqlite', 'path': 'conf/prestashop.db', 'batch_size': '2'}, **options)
+
+    return core.PSApiWrapper(config=make_config(sink='database', database=options))
+
+
+def test_database_sink_writes_batches(make_config, mock_server):
+    wrapper = database_wrapper(make_config, mock_server)
+    assert isinstance(wrapper.sink, sinks.DatabaseSink)
+
+    batches = []
+    wrapper.sink.add_hook(batches.append)
+    products = [MergeResult(product_id=product_id, price='12.30', offer_id='o' + product_id)
+                for product_id in ('1', '3', '100000', '5')]
+
+    results = list(wrapper.sink.update_all(products))
+
+    assert [(product.product_id, success) for product, success in results] == [('1', True), ('3', True),
+                                                                              ('100000', False), ('5', True)]
+    assert batches == [['1', '3'], ['5']]
+    for table in ('ps_product', 'ps_product_shop'):
+        assert prices('conf/prestashop.db', table) == {1: 10.0, 2: 0, 3: 10.0, 4: 0, 5: 10.0}
+
+    wrapper.close()
+
+
+def test_database_sink_streams_and_filters_shops(make_config, mock_server):
+    wrapper = database_wrapper(make_config, mock_server, shop_ids='2')
+    connection = sqlite3.connect('conf/prestashop.db')
+    connection.execute('INSERT INTO ps_product_shop (id_product, id_shop) VALUES (1, 2)')
+    connection.commit()
+
+    for product_id in ('1', '2', '3'):
+        wrapper.sink.submit(MergeResult(product_id=product_id, price='24.60', offer_id='o' + product_id))
+
+    # The first batch is written once it's full
+    assert [product.product_id for product, _ in wrapper.sink.results()] == ['1', '2']
+    wrapper.sink.flush()
+    assert [(product.product_id, success) for product, success in wrapper.sink.results()] == [('3', True)]
+
+    assert prices('conf/prestashop.db', 'ps_product') == {1: 20.0, 2: 20.0, 3: 20.0, 4: 0, 5: 0}
+    rows = connection.execute('SELECT id_product, id_shop, price FROM ps_product_shop WHERE price > 0').fetchall()
+    assert rows == [(1, 2, 20.0)]
+
+    connection.close()
+    wrapper.close()
+
+
+def test_unavailable_sink_falls_back_to_webservice(make_config):
+    for options in ({'sink': 'ftp'}, {'sink': 'database', 'database': {'driver': 'oracle'}}):
+        wrapper = core.PSApiWrapper(config=make_config(**options))
+        assert isinstance(wrapper.sink, sinks.WebserviceSink)
+        wrapper.close()
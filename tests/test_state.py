@@ -0,0 +1,64 @@
+from Allegro2Prestashop import core, state
+from Allegro2Prestashop.records import Offer
+from benchmarks.mock_servers import ean, price
+
+
+def offers(catalog):
+    return [Offer(ean(number), price(number), str(number)) for number in range(catalog.ps_size)]
+
+
+def planned(wrapper, catalog):
+    to_update, _, unchanged, _, _ = wrapper.plan(offers(catalog))
+    return {product.product_id for product in to_update}, unchanged
+
+
+def test_state_store(tmp_path):
+    db_path = str(tmp_path / 'state.db')
+    with state.StateStore(db_path) as store:
+        store.record('1', '10.0', 'A')
+        store.record('2', '20.0', 'B')
+        # Recorded rows are only visible once committed
+        assert store.get_prices() == {}
+        store.commit()
+        store.record('1', '12.0', 'B')
+
+    with state.StateStore(db_path) as store:
+        assert store.get_prices() == {'1': '12.0', '2': '20.0'}
+        assert {offer: sorted(products) for offer, products in store.get_offer_products().items()} == {'B': ['1', '2']}
+
+
+def test_pushed_prices_are_skipped(make_config, mock_server):
+    catalog = mock_server.catalog
+    wrapper = core.PSApiWrapper(config=make_config(catalog={'fetch_prices': 'false'}))
+
+    to_update, unchanged = planned(wrapper, catalog)
+    assert (len(to_update), unchanged) == (catalog.ps_size - catalog.ps_size // 40 - 1, 0)
+    wrapper.apply(wrapper.plan(offers(catalog))[0], [], 0, send_report=False)
+
+    assert planned(wrapper, catalog) == (set(), len(to_update))
+
+    # --full ignores the state store
+    assert len(wrapper.plan(offers(catalog), full=True)[0]) == len(to_update)
+
+    # Only the price which changed since the last run is pushed
+    changed = offers(catalog)
+    changed[6].price = '99.99'
+    to_update = wrapper.plan(changed)[0]
+    assert [(product.product_id, product.price) for product in to_update] == [('7', '99.99')]
+
+    wrapper.close()
+
+
+def test_prices_edited_in_the_shop_are_put_back(make_config, mock_server):
+    catalog = mock_server.catalog
+    wrapper = core.PSApiWrapper(config=make_config())
+
+    to_update = wrapper.plan(offers(catalog))[0]
+    wrapper.apply(to_update, [], 0, send_report=False)
+    assert planned(wrapper, catalog) == (set(), len(to_update))
+
+    # Edited by the shop admin after the last push
+    catalog.prices[6] = '1.000000'
+    assert planned(wrapper, catalog) == ({'7'}, len(to_update) - 1)
+
+    wrapper.close()
@@ -0,0 +1,53 @@
+import json
+import time
+
+from Allegro2Prestashop import core
+
+
+def store_token(access_token, expires_at):
+    with open('conf/token.json', 'w') as outfile:
+        json.dump({'access_token': access_token, 'refresh_token': 'mock-refresh', 'expires_at': expires_at}, outfile)
+
+
+def auth_requests(mock_server):
+    return mock_server.stats.summary()['endpoints'].get('GET auth/oauth/token', {}).get('count', 0)
+
+
+def test_valid_stored_token_is_reused(make_config, mock_server):
+    store_token('stored-access', time.time() + 3600)
+    fetcher = core.FetchAllegro(config=make_config())
+
+    assert fetcher.token == 'stored-access'
+    assert fetcher.token == 'stored-access'
+    assert auth_requests(mock_server) == 0
+    fetcher.close()
+
+
+def test_expiring_token_is_refreshed_and_stored(make_config, mock_server):
+    # Within token_refresh_margin of its expiry
+    store_token('stored-access', time.time() + 60)
+    fetcher = core.FetchAllegro(config=make_config())
+
+    assert fetcher.token == 'mock-access'
+    assert auth_requests(mock_server) == 1
+
+    with open('conf/token.json') as infile:
+        stored = json.load(infile)
+    assert stored['access_token'] == 'mock-access'
+    assert stored['expires_at'] > time.time() + 40000
+    fetcher.close()
+
+
+def test_rejected_token_is_refreshed_once(make_config, mock_server):
+    store_token('stored-access', time.time() + 3600)
+    mock_server.revoked.add('stored-access')
+    fetcher = core.FetchAllegro(config=make_config())
+
+    offers = [{'id': str(number)} for number in (1, 2, 3)]
+    details = [fetcher._get_price(fetcher.transport, offer) for offer in offers]
+
+    assert [price for _, price in details] == [mock_server.catalog.offer(number)['sellingMode']['price']['amount']
+                                               for number in (1, 2, 3)]
+    assert fetcher.token == 'mock-access'
+    assert auth_requests(mock_server) == 1
+    fetcher.close()
@@ -0,0 +1,80 @@
+from email.utils import formatdate
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+from Allegro2Prestashop.transport import RetryPolicy, TokenBucket, parse_retry_after, received_bytes
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('garbage') is None
+    assert parse_retry_after('2.5') == 2.5
+    assert parse_retry_after('-1') == 0.0
+    assert 25 < parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+    assert parse_retry_after(formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+
+def test_retry_policy_limits_per_kind():
+    policy = RetryPolicy({'429': 2, '5xx': 1}, backoff_base=0.01, backoff_max=1.0)
+
+    assert 0 <= policy.next_delay('429', 0) <= 0.01
+    assert 0 <= policy.next_delay('429', 1) <= 0.02
+    assert policy.next_delay('429', 2) is None
+    assert policy.next_delay('timeout', 0) is None
+    assert policy.next_delay('5xx', 0, retry_after=3) == 3
+
+
+def test_retry_policy_budget():
+    policy = RetryPolicy({'5xx': 10}, backoff_base=0.0, budget=2)
+
+    assert policy.next_delay('5xx', 0) == 0
+    assert policy.next_delay('5xx', 0) == 0
+    assert policy.next_delay('5xx', 0) is None
+    assert policy.next_delay('5xx', 0) is None
+
+    policy.reset()
+    assert policy.next_delay('5xx', 0) == 0
+
+
+def test_token_bucket_halves_and_recovers_up_to_the_limit():
+    bucket = TokenBucket(20, min_rate=4)
+
+    bucket.throttle()
+    assert bucket.rate == 10
+    # Throttled requests in flight lower the rate once
+    bucket.throttle()
+    assert bucket.rate == 10
+
+    bucket.throttled_at -= 1
+    bucket.throttle()
+    bucket.throttled_at -= 1
+    bucket.throttle()
+    assert bucket.rate == 4
+
+    for _ in range(1000):
+        bucket.recover()
+    assert bucket.rate == 20
+
+
+def test_unbounded_token_bucket_starts_limiting_when_throttled():
+    bucket = TokenBucket(0)
+
+    assert all(bucket.reserve() == 0 for _ in range(100))
+    bucket.recover()
+    assert bucket.rate is None
+
+    bucket.throttle(retry_after=5)
+    assert bucket.rate == 50
+    assert 4 < bucket.reserve() <= 5
+
+    for _ in range(1000):
+        bucket.recover()
+    assert bucket.rate > 50
+
+
+def test_received_bytes_are_the_transferred_ones():
+    body = b'x' * 1000
+    assert received_bytes(CaseInsensitiveDict({'content-length': '120', 'Content-Encoding': 'gzip'}), body) == 120
+    assert received_bytes(CaseInsensitiveDict({'Transfer-Encoding': 'chunked'}), body) == 1000
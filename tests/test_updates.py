@@ -0,0 +1,45 @@
+import pytest
+
+from Allegro2Prestashop import core
+from Allegro2Prestashop.records import Offer
+from benchmarks.mock_servers import ean, price
+
+
+def apply_all(wrapper, catalog):
+    to_update = wrapper.plan([Offer(ean(number), price(number), str(number)) for number in range(catalog.ps_size)])[0]
+    return to_update, wrapper.apply(to_update, [], 0, send_report=False)
+
+
+def requests(mock_server, method):
+    return mock_server.stats.summary()['endpoints'].get(method + ' api/products/{id}', {}).get('count', 0)
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_updates_use_patch(make_config, mock_server, engine):
+    wrapper = core.PSApiWrapper(config=make_config(engine))
+    to_update, report = apply_all(wrapper, mock_server.catalog)
+
+    assert (report.values['updated'], report.values['failed']) == (len(to_update), 0)
+    assert requests(mock_server, 'PATCH') == len(to_update)
+    assert requests(mock_server, 'GET') == requests(mock_server, 'PUT') == 0
+    assert mock_server.catalog.prices[6] == '%.6f' % round(float(price(6)) / 1.23, 2)
+    wrapper.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+@pytest.mark.parametrize('status', [405, 501])
+def test_updates_fall_back_to_put_without_patch(make_config, mock_server, engine, status):
+    mock_server.patch = False
+    mock_server.patch_status = status
+    wrapper = core.PSApiWrapper(config=make_config(engine))
+    to_update, report = apply_all(wrapper, mock_server.catalog)
+
+    assert wrapper.patch_supported is False
+    assert (report.values['updated'], report.values['failed']) == (len(to_update), 0)
+    # The first PATCH is neither retried nor slows the shop requests down
+    assert requests(mock_server, 'PATCH') == 1
+    assert requests(mock_server, 'GET') == len(to_update)
+    assert mock_server.stats.summary()['endpoints']['PUT api/products']['count'] == len(to_update)
+    assert all(bucket.rate is None for bucket in wrapper.transport.buckets.values())
+    assert mock_server.catalog.prices[6] == '%.6f' % round(float(price(6)) / 1.23, 2)
+    wrapper.close()